@@ -0,0 +1,43 @@
+'''Compare the response encoder against the jsonify(serialize(...)) path it
+replaced, with orjson and with the stdlib json fallback.
+
+    python -m benchmarks.encode_bench
+'''
+import json
+from datetime import datetime
+import numpy as np
+from bson import ObjectId
+from flask import Flask, jsonify
+import pyro.utils
+from pyro.utils import serialize, encode
+from benchmarks.serialize_bench import make_doc, bench
+
+
+def legacy_response(docs):
+    return jsonify(serialize(docs)).get_data()
+
+
+def stdlib_encode(docs):
+    orjson, pyro.utils.orjson = pyro.utils.orjson, None
+    try:
+        return encode(docs)
+    finally:
+        pyro.utils.orjson = orjson
+
+
+if __name__ == '__main__':
+    docs = [make_doc() for _ in range(20)]
+    with Flask(__name__).app_context():
+        assert json.loads(encode(docs)) == json.loads(legacy_response(docs))
+        assert stdlib_encode(docs) == encode(docs)
+        number = 50
+        old = bench('jsonify(serialize(docs))', legacy_response, docs, number)
+        new = bench('encode(docs), stdlib json', stdlib_encode, docs, number)
+        print('  speedup: {:.2f}x'.format(old / new))
+        if pyro.utils.orjson is not None:
+            new = bench('encode(docs), orjson', encode, docs, number)
+            print('  speedup: {:.2f}x'.format(old / new))
+    leaves = {'_id': ObjectId(), 'read_at': datetime(2017, 7, 21, 10, 31),
+              'score': np.float64(0.5), 'counts': np.arange(3)}
+    assert stdlib_encode(leaves) == encode(leaves)
+    print(encode(leaves).decode())
@@ -0,0 +1,83 @@
+'''Compare pyro.utils serialize/deserialize against the original recursive,
+uncached implementations on nested documents.
+
+    python -m benchmarks.serialize_bench
+'''
+import re
+import timeit
+from bson import ObjectId
+from pyro.utils import serialize, deserialize
+
+
+# ------------- ORIGINAL IMPLEMENTATIONS, KEPT FOR COMPARISON -------------
+# (List elements inherit their list's key so strings/ObjectIds in arrays
+# don't crash the _id check, matching the current behaviour.)
+def legacy_camel_to_snake(camel):
+    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', camel)
+    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+
+
+def legacy_snake_to_camel(snake):
+    return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), snake)
+
+
+def legacy_deserialize(obj, key=None):
+    if (type(obj) is list):
+        return [legacy_deserialize(el, key) for el in obj]
+    elif (type(obj) is dict):
+        ndict = {}
+        for k,v in obj.items():
+            nk = legacy_camel_to_snake(k)
+            ndict[nk] = legacy_deserialize(v, key=nk)
+        return ndict
+    else:
+        if (type(obj) is str) and (re.search(r'(_id)', key or '')):
+            return ObjectId(obj)
+        return obj
+
+
+def legacy_serialize(obj, key=None):
+    if (type(obj) is list):
+        return [legacy_serialize(el, key) for el in obj]
+    elif (type(obj) is dict):
+        ndict = {}
+        for k,v in obj.items():
+            ndict[legacy_snake_to_camel(k)] = legacy_serialize(v, key=k)
+        return ndict
+    else:
+        if (type(obj) is ObjectId) and (re.search(r'(_id)', key or '')):
+            return str(obj)
+        return obj
+# -------------------------------------------------------------------------
+
+
+def make_doc(width=8, depth=3):
+    '''A Mongo-style document with nested sub-documents and arrays.'''
+    doc = {'_id': ObjectId(), '_author_id': ObjectId(), 'title': 'Ulysses',
+           'page_count': 732, 'created_at': '2017-07-21 10:31:07'}
+    if depth > 0:
+        doc['chapter_list'] = [make_doc(width // 2, depth - 1)\
+                for _ in range(width)]
+        doc['reading_stats'] = {'times_read': 3, 'last_read_by': 'mjl',
+                'ratings': list(range(width * 4))}
+    return doc
+
+
+def bench(label, fn, arg, number):
+    seconds = min(timeit.repeat(lambda: fn(arg), number=number, repeat=5))
+    print('{:<32s} {:8.1f} us/call'.format(label, 1e6 * seconds / number))
+    return seconds
+
+
+if __name__ == '__main__':
+    docs = [make_doc() for _ in range(20)]
+    wire = legacy_serialize(docs)
+    assert serialize(docs) == wire
+    assert deserialize(wire) == legacy_deserialize(wire)
+    number = 50
+    old = bench('legacy serialize', legacy_serialize, docs, number)
+    new = bench('serialize', serialize, docs, number)
+    print('  speedup: {:.2f}x'.format(old / new))
+    old = bench('legacy deserialize', legacy_deserialize, wire, number)
+    new = bench('deserialize', deserialize, wire, number)
+    print('  speedup: {:.2f}x'.format(old / new))
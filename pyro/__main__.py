@@ -0,0 +1,92 @@
+'''Command line entry point.
+
+    python -m pyro serve module:Pyro --bind 0.0.0.0:8000 --workers 4
+
+serves the models registered on Pyro (or on whatever attribute of module is
+named) with Application.serve. The target may also be an Application. Models
+not yet attached to a database are attached to the one given by --database
+and --uri.
+
+    python -m pyro migrate-timestamps module:Pyro
+
+converts timestamps stored as strings by older versions of Pyro to UTC
+datetimes (see Pyro.migrate_timestamps).
+'''
+import argparse
+import importlib
+import sys
+from pyro.application import Application
+
+
+def load_target(target):
+    '''Import module:attribute (attribute defaults to Pyro).'''
+    module_name, _, attribute = target.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute or 'Pyro')
+
+
+def serve(args):
+    target = load_target(args.target)
+    if isinstance(target, Application):
+        application = target
+    else:
+        if target._db is None:
+            target.attach_db(database=args.database, uri=args.uri)
+        application = Application(target, metrics=args.metrics,\
+                slow_request=args.slow_request)
+    application.serve(bind=args.bind, workers=args.workers,\
+            threads=args.threads, timeout=args.timeout,\
+            graceful_timeout=args.graceful_timeout,\
+            max_requests=args.max_requests,\
+            max_requests_jitter=args.max_requests // 10,\
+            accesslog=args.access_log)
+
+
+def migrate(args):
+    target = load_target(args.target)
+    if target._db is None:
+        target.attach_db(database=args.database, uri=args.uri)
+    for name, count in sorted(target.migrate_timestamps().items()):
+        print('{:s}: {:d} documents converted'.format(name, count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyro')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    server = commands.add_parser('serve', help='serve models over HTTP')
+    server.add_argument('target', help='module:Pyro or module:application')
+    server.add_argument('--bind', default='127.0.0.1:5000')
+    server.add_argument('--workers', type=int, default=None,\
+            help='worker processes (default: 2 per CPU + 1)')
+    server.add_argument('--threads', type=int, default=8,\
+            help='threads per worker (default: 8)')
+    server.add_argument('--timeout', type=int, default=30,\
+            help='seconds before a silent worker is restarted')
+    server.add_argument('--graceful-timeout', type=int, default=30,\
+            help='seconds workers get to finish requests on reload/stop')
+    server.add_argument('--max-requests', type=int, default=0,\
+            help='recycle a worker after this many requests (0: never)')
+    server.add_argument('--access-log', default=None,\
+            help="access log file ('-' for stdout)")
+    server.add_argument('--metrics', action='store_true',\
+            help='serve Prometheus metrics at /_metrics')
+    server.add_argument('--slow-request', type=float, default=None,\
+            help='log requests taking at least this many seconds')
+    server.add_argument('--database', default='dev')
+    server.add_argument('--uri', default=None)
+    migration = commands.add_parser('migrate-timestamps',\
+            help='convert string timestamps to UTC datetimes')
+    migration.add_argument('target', help='module:Pyro or module:Model')
+    migration.add_argument('--database', default='dev')
+    migration.add_argument('--uri', default=None)
+    args = parser.parse_args(argv)
+    if args.command == 'migrate-timestamps':
+        migrate(args)
+    else:
+        serve(args)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, '') # serve modules from the working directory
+    main()
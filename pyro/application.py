@@ -1,16 +1,29 @@
-from flask import Flask, request, jsonify, Response
-from flask_cors import CORS, cross_origin
-from ipdb import set_trace as debug
+from flask import Flask, Response, request
+from flask_cors import CORS
+import logging
+import multiprocessing
+from pyro.metrics import start_request, finish_request, render,\
+        CONTENT_TYPE
 
+logger = logging.getLogger(__name__)
 
-class Application(object):
 
-    def __init__(self, Pyro, url_prefix=''):
+class Application(object):
 
+    def __init__(self, Pyro, url_prefix='', metrics=False, slow_request=None):
+        '''Serve the models registered on Pyro. Every request is timed; with
+           metrics, timings are served at /_metrics for Prometheus. Requests
+           taking slow_request seconds or more are logged, along with their
+           Mongo commands.'''
         self.prefix = url_prefix
+        self.slow_request = slow_request
         self.app = app = Flask(__name__)
-        valid_headers = ['Content-Type', 'Access-Control-Allow-Origin', '*']
-        CORS(self.app)
+        CORS(self.app, expose_headers=['X-Next-Cursor'])
+        Pyro.ensure_indexes()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        if metrics:
+            app.add_url_rule('/_metrics', '_metrics', self._metrics)
 
         for DataClass in Pyro:
             available_routes = DataClass._routes()
@@ -18,6 +31,61 @@ class Application(object):
                 app.add_url_rule(data['route'], route_name, data['callback'],\
                         methods=data['methods'])
 
-    def run(self):
-        '''Launch the server.'''
-        self.app.run()
+    def _start_request(self):
+        start_request() # returning anything would replace the response
+
+    def _finish_request(self, resp):
+        finish_request(request.endpoint or 'unmatched', request.method,\
+                resp.status_code, request.full_path.rstrip('?'),\
+                self.slow_request)
+        return resp
+
+    @staticmethod
+    def _metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    def run(self, **options):
+        '''Launch the server. Options (threaded, port, etc.) go to Flask.'''
+        self.app.run(**options)
+
+    def serve(self, bind='127.0.0.1:5000', workers=None, threads=8,\
+            **options):
+        '''Serve the app from a pre-forking gunicorn server.
+
+        Runs workers processes (by default two per CPU, plus one), each with
+        threads threads, and blocks until the server shuts down. An open
+        events stream holds a thread for as long as the client listens, so a
+        single-threaded (sync) worker would serve nothing else meanwhile. Other options
+        are gunicorn settings (timeout, graceful_timeout, max_requests,
+        accesslog, ...). Send the master SIGHUP to gracefully replace its
+        workers. Each worker reconnects to Mongo after it is forked.
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count() * 2 + 1
+        if threads < 2:
+            logger.warning('Serving with one thread per worker: each open '\
+                    'events stream takes a whole worker. Use threads > 1, '\
+                    'or AsyncApplication, if clients listen for changes.')
+        options = dict(options, bind=bind, workers=workers, threads=threads)
+        gunicorn_application(self.app, options).run()
+
+
+def gunicorn_application(app, options):
+    '''Wrap a WSGI app in a gunicorn application configured by options.'''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError('Application.serve needs gunicorn; '\
+                'pip install gunicorn')
+
+    class PyroServer(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    return PyroServer()
@@ -0,0 +1,605 @@
+'''Serve Pyro models from an ASGI server (uvicorn, hypercorn, ...).
+
+AsyncApplication builds the same routes as Application. Index, show, create,
+update and destroy run as coroutines over an async Mongo driver, so a single
+process can keep many requests waiting on Mongo at once. Hooks may be
+coroutines; ordinary (blocking) hooks are run in a thread pool. Everything else
+is handed to the Flask application, also in the pool: the routes with no async
+controller (count, aggregate, upsert, the bulk routes, CORS preflight), delta
+syncs (index with ?since=), and index and create on routes nested more than a
+level deep. Flask records the metrics for the requests it answers.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import partial
+import inspect
+import io
+import json
+import logging
+import sys
+import time
+from itertools import islice
+from pyro.application import Application
+from pyro.core import *
+from pyro.events import Subscriber
+from pyro.metrics import start_request, finish_request, discard_request,\
+        record_serialization
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Request, Response
+
+
+logger = logging.getLogger(__name__)
+
+# Actions served by coroutines; everything else goes to the Flask app.
+ASYNC_ACTIONS = ('index', 'show', 'create', 'update', 'destroy', 'events')
+
+# Headers the Flask app's CORS setup sends along with every response.
+CORS_HEADERS = [('Access-Control-Allow-Origin', '*'),\
+        ('Access-Control-Expose-Headers', 'X-Next-Cursor')]
+
+
+async def run_in(executor, fn, *args, **kwargs):
+    '''Run a blocking call in executor, keeping the caller's contextvars.'''
+    call = partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+
+def overrides(Model, *hooks):
+    '''Does Model replace any of Pyro's no-op hooks with its own?'''
+    return any(getattr(Model, hook) is not getattr(Pyro, hook)\
+            for hook in hooks)
+
+
+class ThreadedCursor(object):
+    '''Async face on a synchronous cursor; batches are fetched in a pool.'''
+
+    def __init__(self, cursor, executor):
+        self.cursor = cursor
+        self.executor = executor
+        self._batch_size = 100
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, limit):
+        self.cursor = self.cursor.limit(limit)
+        return self
+
+    def batch_size(self, batch_size):
+        self.cursor = self.cursor.batch_size(batch_size)
+        self._batch_size = batch_size
+        return self
+
+    async def to_list(self, length=None):
+        return await run_in(self.executor, list, islice(self.cursor, length))
+
+    async def __aiter__(self):
+        while True:
+            batch = await run_in(self.executor, list,\
+                    islice(self.cursor, self._batch_size))
+            if not batch:
+                return
+            for doc in batch:
+                yield doc
+
+
+class ThreadedCollection(object):
+    '''Async face on a synchronous collection, e.g. a mongomock one handed to
+       attach_db. Each call runs in a thread pool.'''
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self.executor = executor
+
+    def find(self, *args, **kwargs):
+        return ThreadedCursor(self.collection.find(*args, **kwargs),\
+                self.executor)
+
+    def __getattr__(self, name): # find_one, insert_one, update_one, ...
+        method = getattr(self.collection, name)
+        return partial(run_in, self.executor, method)
+
+
+class StreamingResponse(Response):
+    '''Response whose body is produced by an async iterator of bytes.'''
+
+    def __init__(self, chunks, **kwargs):
+        super(StreamingResponse, self).__init__(**kwargs)
+        self.chunks = chunks
+
+
+class AsyncSubscriber(Subscriber):
+    '''A subscriber to model events served on the event loop. Events may be
+       published from any thread; they are handed over to the loop.'''
+
+    def __init__(self, matches, size, loop):
+        super(AsyncSubscriber, self).__init__(matches, size)
+        self.events = asyncio.Queue(size)
+        self.loop = loop
+
+    def _put(self, event):
+        self.loop.call_soon_threadsafe(self._put_nowait, event)
+
+    def _put_nowait(self, event):
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout):
+        '''The next event, or None if none came within timeout seconds.'''
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def disconnected(receive):
+    '''Wait for the client to go away (its request body already read).'''
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def json_response(package, status=200):
+    '''JSON response for an already serialized package.'''
+    return Response(json.dumps(package), status=status,\
+            mimetype='application/json')
+
+
+def wsgi_environ(scope, body):
+    '''Translate an ASGI http scope (and its body) into a WSGI environ.'''
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{:s}'.format(scope.get('http_version',\
+                '1.1')),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ: # repeated header
+            value = '{:s},{:s}'.format(environ[name], value)
+        environ[name] = value
+    environ['CONTENT_LENGTH'] = str(len(body)) # the body is already read
+    return environ
+
+
+async def read_body(receive):
+    '''Collect the request body from the ASGI receive channel.'''
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+class AsyncApplication(object):
+
+    def __init__(self, Pyro, threads=32, metrics=False, slow_request=None):
+        '''Build the ASGI application for the models registered on Pyro;
+           threads sizes the pool that runs blocking hooks. metrics and
+           slow_request are as for Application.'''
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slow_request = slow_request
+        self.flask_app = Application(Pyro, metrics=metrics,\
+                slow_request=slow_request).app # for everything not async
+        self.url_map = Map()
+        self.endpoints = {}
+        for DataClass in Pyro:
+            for route_name, data in DataClass._routes().items():
+                if data['action'] not in ASYNC_ACTIONS:
+                    continue
+                self.url_map.add(Rule(data['route'], endpoint=route_name,\
+                        methods=data['methods']))
+                Model = data['callback'].__self__ # e.g. the child, if nested
+                self.endpoints[route_name] = (Model, data['action'])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope: ' + scope['type'])
+        environ = wsgi_environ(scope, await read_body(receive))
+        try:
+            endpoint, values = self.url_map.bind_to_environ(environ).match()
+        except HTTPException: # not ours; Flask answers (404, 405, OPTIONS)
+            resp = await self._fallback(environ)
+            return await self._send(send, resp, scope['method'], receive)
+        Model, action = self.endpoints[endpoint]
+        controller = getattr(self, '_{:s}'.format(action))
+        start_request()
+        try:
+            resp = await controller(Model, Request(environ), **values)
+        except HTTPException as error:
+            resp = error.get_response(environ)
+        except Exception:
+            logger.exception('Error serving %s %s', scope['method'],\
+                    scope['path'])
+            resp = json_response({'errors': ['Internal server error.']}, 500)
+        for header, value in CORS_HEADERS:
+            resp.headers.setdefault(header, value)
+        finish_request(endpoint, scope['method'], resp.status_code,\
+                scope['path'], self.slow_request)
+        await self._send(send, resp, scope['method'], receive)
+
+    async def _fallback(self, environ):
+        '''Have the Flask application answer, in the thread pool. Flask
+           records the request's metrics, so they are not recorded here.'''
+        discard_request()
+        return await run_in(self.executor, Response.from_app,\
+                self.flask_app, environ, buffered=True)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send(self, send, resp, method, receive):
+        '''Send a werkzeug response over the ASGI send channel. Streams stop
+           early if the client goes away.'''
+        headers = [(name.lower().encode('latin1'), value.encode('latin1'))\
+                for name, value in resp.headers.items()]
+        await send({'type': 'http.response.start',\
+                'status': resp.status_code, 'headers': headers})
+        if method != 'HEAD' and isinstance(resp, StreamingResponse):
+            gone = asyncio.ensure_future(disconnected(receive))
+            try:
+                async for chunk in resp.chunks:
+                    if gone.done():
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk,\
+                            'more_body': True})
+                else:
+                    await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                gone.cancel()
+                await resp.chunks.aclose() # e.g. unsubscribe, now
+        else:
+            body = resp.get_data() if method != 'HEAD' else b''
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def _call(self, hook, *args):
+        '''Run a hook: await a coroutine, skip Pyro's no-op defaults, and
+           hand anything else to the thread pool.'''
+        if inspect.iscoroutinefunction(hook):
+            return await hook(*args)
+        if getattr(hook, '__func__', hook) is getattr(Pyro, hook.__name__,\
+                None):
+            return hook(*args)
+        return await run_in(self.executor, hook, *args)
+
+    async def _construct(self, Model, make, *args):
+        '''Build a model object; its new-model hooks may block.'''
+        if overrides(Model, 'before_new_model', 'after_new_model'):
+            return await run_in(self.executor, make, *args)
+        return make(*args)
+
+    def _collection(self, Model):
+        '''Async collection for Model: through the async driver when Model
+           was attached by uri, otherwise a threaded wrapper around the
+           collection of the database it was handed.'''
+        collection = Model._collection()
+        config = Model._db_config
+        if config is None:
+            return ThreadedCollection(collection, self.executor)
+        options = dict(config)
+        options.pop('database_name')
+        client = get_async_client(options.pop('uri'), **options)
+        return client[collection.database.name][collection.name]
+
+    def _respond(self, params):
+        '''The response a controller settled on, after its hooks had a say.'''
+        resp = params['resp']
+        if not isinstance(resp, Response):
+            resp = json_response(resp)
+        resp.status_code = params['status_code']
+        return resp
+
+    def _to_response(self, package):
+        start = time.perf_counter()
+        body = encode(package)
+        record_serialization(time.perf_counter() - start)
+        return Response(body, mimetype='application/json')
+
+    def _conditional_response(self, Model, request, package, include=None):
+        '''As Pyro._conditional_response, for an explicit request.'''
+        etag, last_modified = validators(package, include or (),\
+                request.query_string)
+        if not_modified(request, etag, last_modified):
+            resp = Response(status=304)
+        else:
+            resp = self._to_response(package)
+        return cache_headers(resp, etag, last_modified, Model.cache_control)
+
+    # -------------- MODEL OPERATIONS -------------------------------
+    async def _find_by_id(self, Model, _id, fields=None):
+        '''As Pyro.find_by_id.'''
+        _id = ObjectId(_id)
+        collection = self._collection(Model)
+        if Model._cache is not None and fields is None: # read through cache
+            doc, generation = await run_in(self.executor, Model._cached, _id)
+            if doc is None:
+                doc = await find_document(_id, collection)
+                await run_in(self.executor, Model._cache_doc, _id, doc,\
+                        generation)
+        else:
+            doc = await find_document(_id, collection,\
+                    Model._projection(fields))
+        if doc is None:
+            return False
+        return await self._construct(Model, Model._from_db, doc)
+
+    async def _save(self, obj, operators=None):
+        '''As Pyro.save, or Pyro.modify when given update operators. Returns
+           False if the document no longer exists.'''
+        obj._sync_doc()
+        collection = self._collection(type(obj))
+        found = True
+        if obj.doc_exists:
+            await self._call(obj.before_update_model)
+            query, update = obj._prepare_update(operators)
+            if operators:
+                doc = await collection.find_one_and_update(query, update,\
+                        return_document=ReturnDocument.AFTER)
+                found = doc is not None
+            else:
+                result = await collection.update_one(query, update)
+                doc, found = None, result.matched_count > 0
+            await self._uncache(obj)
+            obj._updated(found, doc)
+            await self._call(obj.after_update_model)
+        else:
+            await self._call(obj.before_save_model)
+            obj._prepare_insert()
+            response = await collection.insert_one(obj._doc)
+            obj._inserted(response.inserted_id)
+            await self._call(obj.after_save_model)
+        obj._finally()
+        return found
+
+    async def _delete(self, obj):
+        '''As Pyro.delete.'''
+        await self._call(obj.before_delete_model)
+        await self._collection(type(obj)).delete_one(qwrap(obj._id))
+        await self._uncache(obj)
+        if obj._tracks_changes:
+            await run_in(self.executor, obj._bury, [obj])
+        obj._announce('delete', [obj])
+        await self._call(obj.after_delete_model)
+
+    async def _uncache(self, obj):
+        if obj._cache is not None:
+            await run_in(self.executor, obj._uncache, obj._id)
+
+    async def _with_related(self, Model, docs, include=None):
+        '''As Pyro.with_related: one query per relation for all of docs.'''
+        for RelatedClass in Model._related_classes(include):
+            cursor = self._collection(RelatedClass).find(\
+                    Model._related_query(docs, RelatedClass))
+            Model._attach_related(docs, RelatedClass,\
+                    await cursor.to_list(None))
+        return docs
+
+    async def _stream(self, Model, cursor, include, chunk_size=500):
+        '''Yield a JSON array a chunk of documents at a time.'''
+        separator = '['
+        chunk = []
+        async for doc in cursor:
+            chunk.append(doc)
+            if len(chunk) < chunk_size:
+                continue
+            yield await self._encode_chunk(Model, chunk, include, separator)
+            separator, chunk = ',', []
+        if chunk:
+            yield await self._encode_chunk(Model, chunk, include, separator)
+            separator = ','
+        yield b'[]' if separator == '[' else b']'
+
+    async def _encode_chunk(self, Model, docs, include, separator):
+        await self._with_related(Model, docs, include)
+        return separator.encode() + b','.join(encode(doc) for doc in docs)
+
+    # -------------- CONTROLLER METHODS -----------------------------
+    async def _index(self, Model, request, resource_id=None, **ancestor_ids):
+        '''List all resources.'''
+        # Delta syncs, and routes nested more than a level deep, are Flask's.
+        if 'since' in request.args or ancestor_ids:
+            return await self._fallback(request.environ)
+        try:
+            limit, after, stream, include = index_params(request.args)
+            fields = fields_param(request.args)
+            Model._related_classes(include)
+            query, sort = parse_query(request.args)
+            if sort and after is not None:
+                raise ValueError('after cannot be combined with sort')
+        except ValueError as error:
+            return json_response({'errors': [str(error)]}, 400)
+
+        params = assemble_params(Model, 'index', resource_id, request)
+        params['query'] = query
+        await self._call(Model.before_index, params)
+        if params['status_code'] > 399:
+            return json_response(params['response'], params['status_code'])
+        query = params['query']
+        if resource_id: # a nested resource!
+            query[Model._parent._foreign_key()] = ObjectId(resource_id)
+        collection = self._collection(Model)
+        projection = Model._projection(fields)
+        if stream: # hand documents to the client as the cursor yields them
+            cursor = find_page(collection, query, limit, after,\
+                    projection=projection, sort=sort)
+            docs = self._stream(Model, cursor, include)
+            params[Model._plural_name] = docs
+            await self._call(Model.after_index, params)
+            resp = StreamingResponse(docs, mimetype='application/json')
+            return cache_headers(resp, None, None, Model.cache_control)
+        if limit is None and after is None and not sort:
+            cursor = collection.find(query, projection)
+        else:
+            fetch = limit + 1 if limit is not None else None
+            cursor = find_page(collection, query, fetch, after,\
+                    projection=projection, sort=sort)
+        docs = await cursor.to_list(None)
+        next_cursor = None
+        if limit is not None and len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = None if sort else str(docs[-1]['_id'])
+        await self._with_related(Model, docs, include)
+        params[Model._plural_name] = docs
+        await self._call(Model.after_index, params)
+        resp = self._conditional_response(Model, request, docs, include)
+        if next_cursor is not None:
+            resp.headers['X-Next-Cursor'] = next_cursor
+        return resp
+
+    async def _events(self, Model, request, resource_id=None,\
+            **ancestor_ids):
+        '''Stream changes to the resources, as Pyro._events does. Each
+           subscriber costs a queue on the loop rather than a thread.'''
+        try:
+            query = parse_filter(request.args)
+        except ValueError as error:
+            return json_response({'errors': [str(error)]}, 400)
+        params = assemble_params(Model, 'events', resource_id, request,\
+                ancestor_ids)
+        params['query'] = query
+        await self._call(Model.before_index, params)
+        if params['status_code'] > 399:
+            return json_response(params['response'], params['status_code'])
+        query = params['query']
+        if resource_id: # a nested resource!
+            query[Model._parent._foreign_key()] = ObjectId(resource_id)
+        try:
+            matches({}, query)
+        except ValueError as error:
+            return json_response({'errors': [str(error)]}, 400)
+        if ancestor_ids and not await run_in(self.executor,\
+                Model._find_parent, resource_id, ancestor_ids):
+            return json_response({}, 404) # ancestry checked once, up front
+        subscriber = AsyncSubscriber(event_filter(query), Model.event_buffer,\
+                asyncio.get_running_loop())
+        bus = await run_in(self.executor, bus_for, Model) # may open a stream
+        resumed = bus.subscribe(subscriber,\
+                request.headers.get('Last-Event-ID'))
+        return StreamingResponse(self._event_stream(Model, bus, subscriber,\
+                resumed), mimetype='text/event-stream', headers=EVENT_HEADERS)
+
+    async def _event_stream(self, Model, bus, subscriber, resumed):
+        try:
+            yield PREAMBLE
+            if not resumed:
+                yield RESET.sse()
+            while not subscriber.overflowed:
+                event = await subscriber.get(Model.event_heartbeat)
+                yield HEARTBEAT if event is None else event.sse()
+        finally:
+            bus.unsubscribe(subscriber)
+
+    async def _create(self, Model, request, resource_id=None,\
+            **ancestor_ids):
+        '''Create a new resource.'''
+        if ancestor_ids: # nested more than a level deep; Flask's
+            return await self._fallback(request.environ)
+        params = assemble_params(Model, 'create', resource_id, request)
+        await self._call(Model.before_create, params)
+        parent = None
+        if resource_id is not None: # nested create!
+            parent = await self._find_by_id(Model._parent, resource_id)
+            if not parent:
+                return json_response({}, 404)
+        obj = await self._construct(Model, Model.new, request.json, parent)
+        await self._save(obj)
+        params['resp'] = self._to_response(obj._doc)
+        params[Model._singular_name] = obj
+        await self._call(Model.after_create, params)
+        return self._respond(params)
+
+    async def _show(self, Model, request, resource_id):
+        '''Find the specified resource.'''
+        try:
+            fields = fields_param(request.args)
+        except ValueError as error:
+            return json_response({'errors': [str(error)]}, 400)
+        params = assemble_params(Model, 'show', resource_id, request)
+        await self._call(Model.before_show, params)
+        obj = await self._find_by_id(Model, resource_id, fields)
+        if obj:
+            params['resp'] = self._conditional_response(Model, request,\
+                    obj._doc)
+            params[Model._singular_name] = obj
+            params['status_code'] = params['resp'].status_code
+        else:
+            params['resp'] = json_response({})
+            params['status_code'] = 404
+        await self._call(Model.after_show, params)
+        return self._respond(params)
+
+    async def _update(self, Model, request, resource_id):
+        '''Update the specified resource.'''
+        params = assemble_params(Model, 'update', resource_id, request)
+        await self._call(Model.before_update, params)
+        try:
+            fields, operators = split_update(request.json)
+        except (ValueError, InvalidId) as error:
+            return json_response({'errors': [str(error)]}, 400)
+        obj = await self._find_by_id(Model, resource_id)
+        if obj:
+            obj._doc.update(fields)
+            try:
+                if not await self._save(obj, operators): # deleted meanwhile
+                    obj = False
+            except ValueError as error:
+                return json_response({'errors': [str(error)]}, 400)
+            except OperationFailure as error: # e.g. $inc on a string
+                return json_response({'errors': [server_message(error)]}, 400)
+        if obj:
+            params['resp'] = self._to_response(obj._doc)
+            params[obj._singular_name] = obj
+            params['status_code'] = 200
+        else:
+            params['resp'] = json_response({})
+            params['status_code'] = 404
+        await self._call(Model.after_update, params)
+        return self._respond(params)
+
+    async def _destroy(self, Model, request, resource_id):
+        '''Delete the specified resource.'''
+        params = assemble_params(Model, 'destroy', resource_id, request)
+        await self._call(Model.before_destroy, params)
+        obj = await self._find_by_id(Model, resource_id)
+        if obj:
+            params['resp'] = json_response({})
+            params[obj._singular_name] = obj
+            await self._delete(obj)
+            params['status_code'] = 200
+        else:
+            params['resp'] = json_response({})
+            params['status_code'] = 404
+        await self._call(Model.after_destroy, params)
+        return self._respond(params)
@@ -0,0 +1,200 @@
+'''Read-through caches for documents fetched by _id.
+
+Caches hold BSON-encoded documents, so every hit hands back a fresh copy that
+callers are free to mutate, and the same bytes can live in a shared store.
+
+A document read on a miss may be stale by the time it is cached: a write can
+land, and invalidate the key, while the read is in flight. So a reader takes
+the key's generation before reading and hands it to set, which skips caching
+if the key has been invalidated since.
+'''
+from collections import OrderedDict
+from fnmatch import fnmatch
+import os
+import threading
+import time
+import bson
+
+
+class DocumentCache(object):
+    '''Interface for document caches, with hit/miss/eviction counters.'''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''Return the cached document for key, or None.'''
+        raise NotImplementedError
+
+    def generation(self, key):
+        '''A token that changes whenever key is invalidated; take it before
+           reading the document to be cached.'''
+        raise NotImplementedError
+
+    def set(self, key, doc, generation=None):
+        '''Cache doc under key, unless key has been invalidated since its
+           generation was taken.'''
+        raise NotImplementedError
+
+    def delete(self, key):
+        '''Forget the document cached under key, if any.'''
+        raise NotImplementedError
+
+    def clear(self, prefix=''):
+        '''Forget every document whose key starts with prefix.'''
+        raise NotImplementedError
+
+    def _count(self, doc):
+        if doc is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return doc
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,\
+                'evictions': self.evictions}
+
+
+class MemoryCache(DocumentCache):
+    '''In-process cache evicting the least recently used documents beyond
+       maxsize, and documents older than ttl seconds (if ttl is given).'''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super(MemoryCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, bson bytes)
+        # Invalidations are numbered; the last maxsize are kept by key, and
+        # any read older than one that was dropped is not cached.
+        self._invalidations = 0
+        self._invalidated = OrderedDict() # key -> its last invalidation
+        self._forgotten = 0 # the last invalidation dropped
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None\
+                    and entry[0] < time.time():
+                del self._entries[key] # expired
+                self.evictions += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        return self._count(bson.decode(entry[1]) if entry else None)
+
+    def generation(self, key):
+        with self._lock:
+            return self._invalidations
+
+    def set(self, key, doc, generation=None):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        data = bson.encode(doc)
+        with self._lock:
+            if generation is not None and (self._forgotten > generation\
+                    or self._invalidated.get(key, 0) > generation):
+                return # invalidated while doc was being read
+            self._entries[key] = (expires_at, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._invalidations += 1
+            self._invalidated[key] = self._invalidations
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.maxsize:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def clear(self, prefix=''):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+            self._invalidations += 1
+            self._forgotten = self._invalidations # reads in flight are stale
+            self._invalidated.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache(DocumentCache):
+    '''Cache kept in a key/value store shared between processes.
+
+    store needs get(key), set(key, value, ex=seconds), delete(*keys) and
+    keys(pattern); a redis.Redis client fits, as does LocalStore. Eviction is
+    left to the store (e.g. redis' maxmemory-policy allkeys-lru), so the
+    evictions counter only tracks this process's view.
+
+    Invalidations leave a marker in the store for invalidation_ttl seconds,
+    which must outlast any read whose result is to be cached.
+    '''
+    invalidation_ttl = 300
+
+    def __init__(self, store, ttl=None, prefix='pyro:'):
+        super(SharedCache, self).__init__()
+        self.store = store
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.store.get(self.prefix + key)
+        return self._count(bson.decode(data) if data is not None else None)
+
+    def generation(self, key):
+        return (self.store.get(self.prefix + '#' + key),\
+                self.store.get(self.prefix + '#'))
+
+    def set(self, key, doc, generation=None):
+        if generation is not None and generation != self.generation(key):
+            return # invalidated while doc was being read
+        self.store.set(self.prefix + key, bson.encode(doc), ex=self.ttl)
+
+    def delete(self, key):
+        self.store.delete(self.prefix + key)
+        self._invalidate(self.prefix + '#' + key)
+
+    def clear(self, prefix=''):
+        keys = list(self.store.keys(self.prefix + prefix + '*'))
+        if keys:
+            self.store.delete(*keys)
+        self._invalidate(self.prefix + '#') # reads in flight are stale
+
+    def _invalidate(self, marker):
+        self.store.set(marker, os.urandom(8), ex=self.invalidation_ttl)
+
+
+class LocalStore(object):
+    '''In-process stand-in for a shared key/value store such as redis.'''
+
+    def __init__(self):
+        self._data = {} # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] is not None and entry[0] < time.time():
+                del self._data[key]
+                entry = None
+        return entry[1] if entry else None
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (time.time() + ex if ex else None, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def keys(self, pattern='*'):
+        with self._lock:
+            return [key for key in self._data if fnmatch(key, pattern)]
@@ -1,19 +1,30 @@
-from ipdb import set_trace as debug
-from flask import jsonify, request
-from datetime import datetime
+from flask import jsonify, request, Response
+import os
+import time
+from datetime import timedelta
 from pyro.database import *
 from pyro.utils import *
+from pyro.query import *
+from pyro.metrics import record_serialization
+from pyro.events import ThreadSubscriber, EVENT_HEADERS, HEARTBEAT,\
+        PREAMBLE, RESET, announce, bus_for, event_filter
 
 
 class PyroMeta(type):
     '''Metaclass for Pyro.'''
 
     def __new__(cls, name, parents, dct):
-        dct['_singular_name'] = camel_to_snake(name)
-        dct['_plural_name'] = plural(camel_to_snake(name))
+        dct.setdefault('_singular_name', camel_to_snake(name))
+        if '_plural_name' not in dct: # declaring it skips inflect entirely
+            dct['_plural_name'] = plural(dct['_singular_name'])
+        dct.setdefault('_collection_name', dct['_plural_name'])
         dct['_parent'] = None
         dct['_children'] = []
-        dct['_doc'] = None
+        dct['_indexes'] = []
+        dct['_upsert_key'] = None
+        dct['_tracks_changes'] = False
+        dct['_tombstone_ttl'] = None
+        dct['_timestamp_indexes'] = []
         return super(PyroMeta, cls).__new__(cls, name, parents, dct)
 
     def __init__(cls, name, bases, nmspc):
@@ -31,15 +42,248 @@ class PyroMeta(type):
 
 class Pyro(object, metaclass=PyroMeta):
     '''Main Pyro class for creating flexible data objects.'''
+    _plural_name = 'pyros' # spelled out, so importing Pyro needs no inflect
     _db = None
+    _db_config = None
+    _cache = None
+    # How far change feed watermarks stay behind the clock, in seconds. A
+    # write is stamped before it reaches Mongo; one stamped just before a sync
+    # may not be visible to it yet, and must not fall behind the watermark.
+    sync_lag = 2
+    # Events a subscriber to /events may fall behind (and the bus replays to
+    # reconnecting ones), and seconds between keep-alives on a quiet stream.
+    event_buffer = 1000
+    event_heartbeat = 15
+    cache_control = None # Cache-Control header for show/index responses
+    # An instance's fields live in its document, which serves as the instance
+    # __dict__; what keeps track of the document lives in slots beside it.
+    __slots__ = ('__dict__', '__weakref__', '_saved', '_related')
 
     @classmethod
-    def attach_db(cls, db=None):
-        '''Attaches a database to the Pyro environment.'''
+    def attach_db(cls, db=None, database='dev', uri=None, collection=None,\
+            **client_options):
+        '''Attaches a database to the Pyro environment.
+
+        Without db, connects to database on the Mongo server at uri through
+        the process's shared, pooled client for that uri and client_options
+        (maxPoolSize, serverSelectionTimeoutMS, socketTimeoutMS,
+        readPreference, w, wTimeoutMS, etc.; see pymongo.MongoClient).
+        Called on a model rather than on Pyro, it overrides the database
+        (and, with collection, the collection name) for that model only.
+        '''
         if db is None:
-            cls._db = connect_to_database()
+            cls._db_config = dict(client_options, database_name=database,\
+                    uri=uri)
+            cls._db = connect_to_database(**cls._db_config)
         else:
+            cls._db_config = None
             cls._db = db
+        if collection is not None:
+            cls._collection_name = collection
+        cls.ensure_indexes()
+
+    @classmethod
+    def _reattach_db(cls):
+        '''Reconnect models that attached by uri, e.g. in a fork() child.'''
+        for Model in [Pyro] + list(Pyro._registry):
+            config = Model.__dict__.get('_db_config')
+            if config:
+                Model._db = connect_to_database(**config)
+
+    @classmethod
+    def attach_cache(cls, cache):
+        '''Serve find_by_id through a read-through cache (a DocumentCache from
+           pyro.cache; None turns caching off). Called on a model rather than
+           on Pyro, it caches that model only.'''
+        cls._cache = cache
+
+    @classmethod
+    def cache_stats(cls):
+        '''Hit/miss/eviction counters of the attached cache, if any.'''
+        return cls._cache.stats if cls._cache is not None else None
+
+    @classmethod
+    def _cache_key(cls, _id):
+        return '{:s}:{:s}'.format(cls._collection().full_name, str(_id))
+
+    @classmethod
+    def _cached(cls, _id):
+        '''The cached document for _id, or None and the generation to hand
+           to _cache_doc once the document has been read.'''
+        key = cls._cache_key(_id)
+        doc = cls._cache.get(key)
+        if doc is not None:
+            return doc, None
+        return None, cls._cache.generation(key) # before the read
+
+    @classmethod
+    def _cache_doc(cls, _id, doc, generation):
+        '''Cache a document read on a miss, unless a write overtook it.'''
+        if doc is not None:
+            cls._cache.set(cls._cache_key(_id), doc, generation)
+
+    @classmethod
+    def _uncache(cls, *ids):
+        '''Drop documents from the cache after they have been written.'''
+        if cls._cache is not None:
+            for _id in ids:
+                cls._cache.delete(cls._cache_key(_id))
+
+    @classmethod
+    def _collection(cls):
+        '''The Mongo collection holding this model's documents.'''
+        return cls._db[cls._collection_name]
+
+    @classmethod
+    def has_index(cls, keys, unique=False, ttl=None, partial=None):
+        '''Declare an index on this model's collection.
+
+        keys is a field name or a list of fields and/or (field, direction)
+        pairs for a compound index; fields are named as in the API (camelCase)
+        and mapped to their stored keys. ttl expires documents that many
+        seconds after the (date) value of the indexed field. partial, a query
+        on stored keys, limits the index to the documents that match it.
+        '''
+        if not isinstance(keys, list):
+            keys = [keys]
+        keys = [key if isinstance(key, tuple) else (key, ASCENDING)\
+                for key in keys]
+        keys = [(stored_field(field), direction) for field, direction in keys]
+        spec = {'keys': keys, 'unique': unique, 'ttl': ttl, 'partial': partial}
+        if spec not in cls._indexes:
+            cls._indexes.append(spec)
+
+    @classmethod
+    def upserts_on(cls, *fields):
+        '''Declare the fields that identify a document for upserts (the
+           upsert method and PATCH /<plural>). They get a unique index, so
+           concurrent upserts can never create duplicates; documents without
+           the fields are left out of it.'''
+        if not fields or any('.' in field for field in fields):
+            raise ValueError('An upsert key is one or more top-level fields.')
+        cls._upsert_key = [stored_field(field) for field in fields]
+        cls.has_index(list(fields), unique=True, partial=dict(\
+                (field, {'$exists': True}) for field in cls._upsert_key))
+
+    @classmethod
+    def has_timestamp_index(cls, *fields):
+        '''Index timestamps (createdAt and updatedAt, unless fields are
+           given) for time range queries and sorts, e.g. GET
+           /<plural>?createdAt__gte=2017-07-01. Nested models index them
+           alongside the foreign key as well.'''
+        for field in fields or TIMESTAMP_FIELDS:
+            if field not in cls._timestamp_indexes:
+                cls._timestamp_indexes.append(field)
+            cls.has_index(field)
+            if cls._parent is not None:
+                cls.has_index([cls._parent._foreign_key(), field])
+
+    @classmethod
+    def tracks_changes(cls, ttl=None):
+        '''Keep a change feed for delta syncs (GET /<plural>?since=...):
+           index updatedAt, and leave a tombstone for each deleted document
+           in the {collection}_tombstones collection. With a ttl, tombstones
+           expire after that many seconds; clients that have not synced
+           for longer must then start over.'''
+        cls._tracks_changes = True
+        cls._tombstone_ttl = ttl
+        cls.has_timestamp_index('updatedAt')
+
+    @classmethod
+    def _tombstones(cls):
+        '''The collection holding tombstones of deleted documents.'''
+        return cls._db['{:s}_tombstones'.format(cls._collection_name)]
+
+    @classmethod
+    def _tombstone_indexes(cls):
+        specs = [{'keys': [('deletedAt', ASCENDING)], 'unique': False,\
+                'ttl': cls._tombstone_ttl, 'partial': None}]
+        if cls._parent is not None:
+            specs.append({'keys': [(cls._parent._foreign_key(), ASCENDING),\
+                    ('deletedAt', ASCENDING)], 'unique': False, 'ttl': None,\
+                    'partial': None})
+        return specs
+
+    @classmethod
+    def _bury(cls, objs):
+        '''Leave tombstones for deleted objects, for the change feed.'''
+        if not cls._tracks_changes or not objs:
+            return
+        stamp = utc_now()
+        tombstones = []
+        for obj in objs:
+            tombstone = {'_id': obj._id, 'deletedAt': stamp}
+            if cls._parent is not None:
+                foreign_key = cls._parent._foreign_key()
+                tombstone[foreign_key] = obj._doc.get(foreign_key)
+            tombstones.append(tombstone)
+        bulk_write_errors(cls._tombstones().insert_many, tombstones)
+
+    @classmethod
+    def _announce(cls, kind, objs=()):
+        '''Tell subscribers to /events of writes, as stored.'''
+        announce(cls, kind, [obj._doc for obj in objs])
+
+    @classmethod
+    def _models(cls):
+        '''Pyro itself stands for every registered model.'''
+        return list(cls._registry) if cls is Pyro else [cls]
+
+    @classmethod
+    def ensure_indexes(cls):
+        '''Create the declared indexes (for every model, if called on Pyro).'''
+        created = {}
+        for Model in cls._models():
+            if Model._db is None:
+                continue
+            collection = Model._collection()
+            created[Model._plural_name] = ensure_indexes(collection,\
+                    Model._indexes)
+            if Model._tracks_changes:
+                created[Model._plural_name] += ensure_indexes(\
+                        Model._tombstones(), Model._tombstone_indexes())
+        return created
+
+    @classmethod
+    def migrate_timestamps(cls, batch_size=1000):
+        '''Convert createdAt and updatedAt (and tombstones' deletedAt) stored
+        as strings by older versions of Pyro, in local time, to UTC datetimes
+        (for every model, if called on Pyro). Returns the number of documents
+        converted per model. Safe to run again, or while serving.
+        '''
+        migrated = {}
+        for Model in cls._models():
+            if Model._db is None:
+                continue
+            collection = Model._collection()
+            migrated[Model._plural_name] = migrate_timestamps(collection,\
+                    TIMESTAMP_FIELDS, batch_size)
+            if Model._tracks_changes:
+                migrated[Model._plural_name] += migrate_timestamps(\
+                        Model._tombstones(), ['deletedAt'], batch_size)
+            if Model._cache is not None: # cached copies hold the strings
+                Model._cache.clear(collection.full_name + ':')
+        return migrated
+
+    @classmethod
+    def index_report(cls):
+        '''Report declared indexes that are missing from the database, and
+           existing indexes Mongo says have never been used (None if the
+           server can't tell us).'''
+        report = {}
+        for Model in cls._models():
+            collection = Model._collection()
+            existing = index_keys(collection)
+            missing = [spec['keys'] for spec in Model._indexes\
+                    if spec['keys'] not in existing.values()]
+            usage = index_usage(collection)
+            unused = None
+            if usage is not None:
+                unused = sorted(name for name, ops in usage.items()\
+                        if ops == 0 and name != '_id_')
+            report[Model._plural_name] = {'missing': missing,\
+                    'unused': unused}
+        return report
 
     @classmethod
     def _routes(cls):
@@ -51,125 +295,332 @@ class Pyro(object, metaclass=PyroMeta):
         route = '/{:s}'.format(cls._plural_name)
         methods = ['GET']
         callback = cls._index
+        action = 'index'
         routes[route_name] = {'route': route, 'methods': methods,\
-            'callback': callback}
+            'callback': callback, 'action': action}
         # show
         route_name = '{:s}.show'.format(cls._singular_name)
         route = '/{:s}/<resource_id>'.format(cls._singular_name)
         methods = ['GET']
         callback = cls._show
+        action = 'show'
         routes[route_name] = {'route': route, 'methods': methods,\
-            'callback': callback}
+            'callback': callback, 'action': action}
         # create
         route_name = '{:s}.create'.format(cls._plural_name)
         route = '/{:s}'.format(cls._plural_name)
         methods = ['POST']
         callback = cls._create
+        action = 'create'
         routes[route_name] = {'route': route, 'methods': methods,\
-            'callback': callback}
+            'callback': callback, 'action': action}
         # update
         route_name = '{:s}.update'.format(cls._singular_name)
         route = '/{:s}/<resource_id>'.format(cls._singular_name)
         methods = ['PUT']
         callback = cls._update
+        action = 'update'
         routes[route_name] = {'route': route, 'methods': methods,\
-            'callback': callback}
+            'callback': callback, 'action': action}
         # destroy
         route_name = '{:s}.destroy'.format(cls._singular_name)
         route = '/{:s}/<resource_id>'.format(cls._singular_name)
         methods = ['DELETE']
         callback = cls._destroy
+        action = 'destroy'
         routes[route_name] = {'route': route, 'methods': methods,\
-            'callback': callback}
+            'callback': callback, 'action': action}
+        # count/aggregate/events
+        for action in ['count', 'aggregate', 'events']:
+            route_name = '{:s}.{:s}'.format(cls._plural_name, action)
+            route = '/{:s}/{:s}'.format(cls._plural_name, action)
+            methods = ['GET']
+            callback = getattr(cls, '_{:s}'.format(action))
+            routes[route_name] = {'route': route, 'methods': methods,\
+                'callback': callback, 'action': action}
+        # upsert, for models that declare an upsert key
+        if cls._upsert_key is not None:
+            route_name = '{:s}.upsert'.format(cls._plural_name)
+            route = '/{:s}'.format(cls._plural_name)
+            methods = ['PATCH']
+            callback = cls._upsert
+            action = 'upsert'
+            routes[route_name] = {'route': route, 'methods': methods,\
+                'callback': callback, 'action': action}
+        # bulk create/update/destroy
+        for verb, method in [('create', 'POST'), ('update', 'PUT'),\
+                ('destroy', 'DELETE')]:
+            action = 'bulk_{:s}'.format(verb)
+            route_name = '{:s}.{:s}'.format(cls._plural_name, action)
+            route = '/{:s}/bulk'.format(cls._plural_name)
+            methods = [method]
+            callback = getattr(cls, '_{:s}'.format(action))
+            routes[route_name] = {'route': route, 'methods': methods,\
+                'callback': callback, 'action': action}
 
-        # Are there any nested routes? Let's check.
-        for child in cls._children:
-            # index - only one level of nesting allowed!
-            route_name = '{:s}.{:s}.index'.format(cls._singular_name,\
-                child._plural_name)
-            route = '/{:s}/<resource_id>/{:s}'.format(cls._singular_name,\
-                child._plural_name)
+        # Nested routes, to any depth: /org/<resource_id>/projects, then
+        # /org/<_org_id>/projects/<resource_id>/tasks, and so on.
+        for child, path, name in cls._nested_routes():
+            # index
+            route_name = '{:s}.index'.format(name)
+            route = path
             methods = ['GET']
             callback = child._index
+            action = 'index'
             routes[route_name] = {'route': route, 'methods': methods,\
-                'callback': callback}
+                'callback': callback, 'action': action}
             # create
-            route_name = '{:s}.{:s}.create'.format(cls._singular_name,\
-                child._plural_name)
-            route = '/{:s}/<resource_id>/{:s}'.format(cls._singular_name,\
-                child._plural_name)
+            route_name = '{:s}.create'.format(name)
+            route = path
             methods = ['POST']
             callback = child._create
+            action = 'create'
+            routes[route_name] = {'route': route, 'methods': methods,\
+                'callback': callback, 'action': action}
+            # bulk create
+            route_name = '{:s}.bulk_create'.format(name)
+            route = '{:s}/bulk'.format(path)
+            methods = ['POST']
+            callback = child._bulk_create
+            action = 'bulk_create'
             routes[route_name] = {'route': route, 'methods': methods,\
-                'callback': callback}
+                'callback': callback, 'action': action}
+            # count/aggregate/events
+            for action in ['count', 'aggregate', 'events']:
+                route_name = '{:s}.{:s}'.format(name, action)
+                route = '{:s}/{:s}'.format(path, action)
+                methods = ['GET']
+                callback = getattr(child, '_{:s}'.format(action))
+                routes[route_name] = {'route': route, 'methods': methods,\
+                    'callback': callback, 'action': action}
+            # upsert
+            if child._upsert_key is not None:
+                route_name = '{:s}.upsert'.format(name)
+                route = path
+                methods = ['PATCH']
+                callback = child._upsert
+                action = 'upsert'
+                routes[route_name] = {'route': route, 'methods': methods,\
+                    'callback': callback, 'action': action}
         return routes
 
+    @classmethod
+    def _nested_routes(cls, lineage=()):
+        '''Yield (child, path, route name) for every model nested under this
+           one, at any depth. The parent's _id is the path's resource_id; the
+           _ids of the ancestors above it are named by their foreign keys.'''
+        lineage = lineage + (cls,)
+        path = '/{:s}'.format(lineage[0]._singular_name)
+        names = [lineage[0]._singular_name]
+        for Ancestor, Model in zip(lineage, lineage[1:]):
+            path += '/<{:s}>/{:s}'.format(Ancestor._foreign_key(),\
+                    Model._plural_name)
+            names.append(Model._plural_name)
+        for child in cls._children:
+            yield child, '{:s}/<resource_id>/{:s}'.format(path,\
+                    child._plural_name), '.'.join(names + [child._plural_name])
+            if child not in lineage: # a model nested under itself stops here
+                for route in child._nested_routes(lineage):
+                    yield route
+
     # -------------- CONTROLLER METHODS -----------------------------
     @classmethod
-    def _index(cls, resource_id=None):
+    def _index(cls, resource_id=None, **ancestor_ids):
         '''List all resources.'''
-        # If we pass query, answer the query rather than all resources.
-        the_query = request.query_string.decode().split('=')
-        if len(the_query) == 2:
-            q_ = {the_query[0]: the_query[1]}
-            results = cls.find_where(q_)
-            return cls._to_response(results)
-
-        params = assemble_params(cls, 'index', resource_id, request)
+        try:
+            limit, after, stream, include = index_params(request.args)
+            fields = fields_param(request.args)
+            cls._related_classes(include)
+            # If we pass query, answer the query rather than all resources.
+            query, sort = parse_query(request.args)
+            if sort and after is not None:
+                raise ValueError('after cannot be combined with sort')
+            since = request.args.get('since')
+            if since is not None and (sort or stream or after is not None):
+                raise ValueError('since cannot be combined with sort, after '\
+                        'or stream')
+        except ValueError as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+
+        params = assemble_params(cls, 'index', resource_id, request,\
+                ancestor_ids)
+        params['query'] = query
         cls.before_index(params) # before hook
         if params['status_code'] > 399:
             # Error detected. EJECT! EJECT!
-            return (jsonify(params['response']), params[status_code], {})
+            return (jsonify(params['response']), params['status_code'], {})
+        query = params['query']
         if resource_id: # a nested resource!
-            query = dict([(cls._parent._foreign_key(), ObjectId(resource_id))])
-            cls._docs = cls.find_where(query)
+            query[cls._parent._foreign_key()] = ObjectId(resource_id)
+        ancestry = cls._ancestry(resource_id, ancestor_ids)
+        if since is not None: # a delta sync
+            try:
+                package = cls.changes_since(since, query, limit, include,\
+                        fields, ancestry)
+            except ValueError as error:
+                return (jsonify({'errors': [str(error)]}), 400, {})
+            params[cls._plural_name] = package['changed']
+            cls.after_index(params) # after hook
+            return cls._to_response(package)
+        if stream: # hand documents to the client as the cursor yields them
+            docs = cls.iter_where(query, after=after, limit=limit,\
+                    include=include, fields=fields, sort=sort,\
+                    ancestry=ancestry)
+            params[cls._plural_name] = docs
+            cls.after_index(params) # after hook
+            resp = Response(stream_json(docs), mimetype='application/json')
+            return cache_headers(resp, None, None, cls.cache_control)
+        if limit is None and after is None and not sort:
+            docs = cls.find_where(query, include, fields, ancestry)
+            next_cursor = None
         else:
-            cls._docs = cls.all()
-        params[cls._plural_name] = cls._docs
+            docs, next_cursor = cls.find_page(query, limit=limit, after=after,\
+                    include=include, fields=fields, sort=sort,\
+                    ancestry=ancestry)
+        params[cls._plural_name] = docs
         cls.after_index(params) # after hook
-        return cls._to_response(cls._docs)
+        resp = cls._conditional_response(docs, include)
+        if next_cursor is not None:
+            resp.headers['X-Next-Cursor'] = next_cursor
+        return resp
+
+    @classmethod
+    def _scoped_query(cls, action, query, resource_id, ancestor_ids):
+        '''Run before_index on the query of a count, aggregate or events
+           route, as the index would, so filters the hook adds apply.
+           Returns the params.'''
+        params = assemble_params(cls, action, resource_id, request,\
+                ancestor_ids)
+        params['query'] = query
+        cls.before_index(params) # before hook
+        if resource_id: # a nested resource!
+            params['query'][cls._parent._foreign_key()] = ObjectId(resource_id)
+        return params
+
+    @classmethod
+    def _count(cls, resource_id=None, **ancestor_ids):
+        '''Count the resources matching the query string's filters.'''
+        try:
+            query = parse_filter(request.args)
+        except ValueError as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+        params = cls._scoped_query('count', query, resource_id, ancestor_ids)
+        if params['status_code'] > 399:
+            return (jsonify(params['response']), params['status_code'], {})
+        count = cls.count(params['query'],\
+                cls._ancestry(resource_id, ancestor_ids))
+        return cls._to_response({'count': count})
+
+    @classmethod
+    def _events(cls, resource_id=None, **ancestor_ids):
+        '''Stream creates, updates and deletes of the resources matching the
+           query string's filters, as Server-Sent Events.'''
+        try:
+            query = parse_filter(request.args)
+        except ValueError as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+        params = cls._scoped_query('events', query, resource_id, ancestor_ids)
+        if params['status_code'] > 399:
+            return (jsonify(params['response']), params['status_code'], {})
+        if ancestor_ids and not cls._find_parent(resource_id, ancestor_ids):
+            return (jsonify({}), 404, {}) # ancestry checked once, up front
+        try: # events are matched in Python, hook's filters and all
+            matches({}, params['query'])
+            wanted = event_filter(params['query'])
+        except ValueError as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+        subscriber = ThreadSubscriber(wanted, cls.event_buffer)
+        bus = bus_for(cls)
+        resumed = bus.subscribe(subscriber,\
+                request.headers.get('Last-Event-ID'))
+        return Response(cls._event_stream(bus, subscriber, resumed),\
+                mimetype='text/event-stream', headers=EVENT_HEADERS)
+
+    @classmethod
+    def _event_stream(cls, bus, subscriber, resumed):
+        '''Write a subscriber's events until it overflows (the client then
+           reconnects, and catches up) or the client goes away.'''
+        try:
+            yield PREAMBLE
+            if not resumed:
+                yield RESET.sse()
+            while not subscriber.overflowed:
+                event = subscriber.get(cls.event_heartbeat)
+                yield HEARTBEAT if event is None else event.sse()
+        finally:
+            bus.unsubscribe(subscriber)
+
+    @classmethod
+    def _aggregate(cls, resource_id=None, **ancestor_ids):
+        '''Group the resources matching the query string's filters, with
+           counts and any sum/avg/min/max asked for.'''
+        try:
+            query, group_by, stats = parse_aggregate(request.args)
+        except ValueError as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+        params = cls._scoped_query('aggregate', query, resource_id,\
+                ancestor_ids)
+        if params['status_code'] > 399:
+            return (jsonify(params['response']), params['status_code'], {})
+        groups = cls.aggregate(params['query'], group_by,\
+                cls._ancestry(resource_id, ancestor_ids), **stats)
+        return cls._to_response(groups)
 
     @classmethod
-    def _create(cls, resource_id=None):
+    def _create(cls, resource_id=None, **ancestor_ids):
         '''Create a new resource.'''
-        params = assemble_params(cls, 'create', resource_id, request)
+        params = assemble_params(cls, 'create', resource_id, request,\
+                ancestor_ids)
         cls.before_create(params) # before hook
         if resource_id is not None: # nested create!
-            parent = cls._parent.find_by_id(resource_id)
-            cls._obj = cls.create(deserialize(request.json), parent)
-            params['resp'] = cls._to_response(cls._obj._doc)
+            parent = cls._find_parent(resource_id, ancestor_ids)
+            if not parent:
+                return (jsonify({}), 404, {})
+            obj = cls.create(deserialize(request.json), parent)
+            params['resp'] = cls._to_response(obj._doc)
         else:
-            cls._obj = cls.create(deserialize(request.json))
-            params['resp'] = cls._to_response(cls._obj._doc)
-        params[cls._singular_name] = cls._obj
+            obj = cls.create(deserialize(request.json))
+            params['resp'] = cls._to_response(obj._doc)
+        params[cls._singular_name] = obj
         cls.after_create(params) # after hook
         return (params['resp'], params['status_code'], {})
 
     @classmethod
-    def _upsert(cls, resource_id=None):
-        '''Upsert a resource. Responds to a patch to the URL.'''
-        debug()
-        params = assemble_params(cls, 'upsert', resource_id, request)
-        data = deserialize(request.json)
-        # Attempt to find the resource using query.
-        matches = cls.find_where(data['query'])
-        if len(matches) == 0: # no matches
-            cls._obj = cls.create(data)
-            params['resp'] = cls._to_response(cls._obj._doc)
-        else:
-            params['resp'] = cls._to_response(matches[0])
+    def _upsert(cls, resource_id=None, **ancestor_ids):
+        '''Update the resource matching the upsert key, or create it.'''
+        params = assemble_params(cls, 'upsert', resource_id, request,\
+                ancestor_ids)
+        cls.before_upsert(params) # before hook
+        parent = None
+        if resource_id is not None: # nested upsert!
+            parent = cls._find_parent(resource_id, ancestor_ids)
+            if not parent:
+                return (jsonify({}), 404, {})
+        if not isinstance(request.json, dict):
+            return (jsonify({'errors': ['Expected a JSON object.']}), 400, {})
+        try:
+            obj = cls.upsert(deserialize(request.json), parent)
+        except (ValueError, InvalidId) as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+        params['resp'] = cls._to_response(obj._doc)
+        params[cls._singular_name] = obj
+        cls.after_upsert(params) # after hook
         return (params['resp'], params['status_code'], {})
 
     @classmethod
     def _show(cls, resource_id):
         '''Find the specified resource'''
+        try:
+            fields = fields_param(request.args)
+        except ValueError as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
         params = assemble_params(cls, 'show', resource_id, request)
         cls.before_show(params) # before hook
-        cls._obj = cls.find_by_id(resource_id)
-        if cls._obj:
-            params['resp'] = cls._to_response(cls._obj._doc)
-            params[cls._singular_name] = cls._obj
-            params['status_code'] = 200
+        obj = cls.find_by_id(resource_id, fields)
+        if obj:
+            params['resp'] = cls._conditional_response(obj._doc)
+            params[cls._singular_name] = obj
+            params['status_code'] = params['resp'].status_code
         else:
             resp = jsonify({})
             params['status_code'] = 404
@@ -182,11 +633,11 @@ class Pyro(object, metaclass=PyroMeta):
         '''Delete the specified resource.'''
         params = assemble_params(cls, 'destroy', resource_id, request)
         cls.before_destroy(params) # before hook
-        cls._obj = cls.find_by_id(resource_id)
-        if cls._obj:
+        obj = cls.find_by_id(resource_id)
+        if obj:
             params['resp'] = jsonify({})
-            params[cls._obj._singular_name] = cls._obj
-            cls._obj.delete()
+            params[obj._singular_name] = obj
+            obj.delete()
             params['status_code'] = 200
         else:
             params['resp'] = jsonify({})
@@ -199,18 +650,132 @@ class Pyro(object, metaclass=PyroMeta):
         '''Update the specified resource.'''
         params = assemble_params(cls, 'update', resource_id, request)
         cls.before_update(params) # before hook
-        cls._obj = cls.find_by_id(resource_id)
-        if cls._obj:
-            cls._obj.__dict__.update(deserialize(request.json))
-            cls._obj.save()
-            params['resp'] = cls._to_response(cls._doc)
-            params[cls._obj._singular_name] = cls._obj
+        try:
+            fields, operators = split_update(request.json)
+        except (ValueError, InvalidId) as error:
+            return (jsonify({'errors': [str(error)]}), 400, {})
+        obj = cls.find_by_id(resource_id)
+        if obj:
+            obj._doc.update(fields)
+            try:
+                if not operators:
+                    obj.save()
+                elif not obj.modify(operators): # deleted in the meantime
+                    obj = False
+            except ValueError as error:
+                return (jsonify({'errors': [str(error)]}), 400, {})
+            except OperationFailure as error: # e.g. $inc on a string
+                return (jsonify({'errors': [server_message(error)]}), 400, {})
+        if obj:
+            params['resp'] = cls._to_response(obj._doc)
+            params[obj._singular_name] = obj
             params['status_code'] = status_code = 200
         else:
             params['resp'] = jsonify({})
             params['status_code'] = status_code = 404
         cls.after_update(params) # after hook
         return (params['resp'], params['status_code'], {})
+
+    @classmethod
+    def _bulk_create(cls, resource_id=None, **ancestor_ids):
+        '''Create many resources from a JSON array.'''
+        parent = None
+        if resource_id is not None: # nested create!
+            parent = cls._find_parent(resource_id, ancestor_ids)
+            if not parent:
+                return (jsonify({}), 404, {})
+        accepted, errors = cls._bulk_before('create', resource_id,\
+                request.get_json(silent=True), ancestor_ids)
+        if errors is None:
+            return (jsonify({'errors': ['Expected a JSON array.']}), 400, {})
+        objs, create_errors = cls.create_many(\
+                [item for _, item in accepted], parent)
+        errors += cls._bulk_reindex(accepted, create_errors)
+        for obj in objs:
+            params = assemble_params(cls, 'create', resource_id, request,\
+                    ancestor_ids)
+            params[cls._singular_name] = obj
+            cls.after_create(params) # after hook
+        created = [serialize(obj._doc) for obj in objs]
+        return cls._bulk_response({'created': created}, errors)
+
+    @classmethod
+    def _bulk_update(cls):
+        '''Update many resources from a JSON array of documents with _ids.'''
+        accepted, errors = cls._bulk_before('update', '_id',\
+                request.get_json(silent=True))
+        if errors is None:
+            return (jsonify({'errors': ['Expected a JSON array.']}), 400, {})
+        objs, update_errors = cls.update_many(\
+                [item for _, item in accepted])
+        errors += cls._bulk_reindex(accepted, update_errors)
+        for obj in objs:
+            params = assemble_params(cls, 'update', str(obj._id), request)
+            params[cls._singular_name] = obj
+            cls.after_update(params) # after hook
+        updated = [serialize(obj._doc) for obj in objs]
+        return cls._bulk_response({'updated': updated}, errors)
+
+    @classmethod
+    def _bulk_destroy(cls):
+        '''Delete many resources given a JSON array of _ids.'''
+        accepted, errors = cls._bulk_before('destroy', '_id',\
+                request.get_json(silent=True))
+        if errors is None:
+            return (jsonify({'errors': ['Expected a JSON array.']}), 400, {})
+        objs, delete_errors = cls.delete_many([item for _, item in accepted])
+        errors += cls._bulk_reindex(accepted, delete_errors)
+        for obj in objs:
+            params = assemble_params(cls, 'destroy', str(obj._id), request)
+            params[cls._singular_name] = obj
+            cls.after_destroy(params) # after hook
+        deleted = [str(obj._id) for obj in objs]
+        return cls._bulk_response({'deleted': deleted}, errors)
+
+    @classmethod
+    def _bulk_before(cls, action, resource_id, items, ancestor_ids=None):
+        '''Run the before hook on each item of a bulk request. Returns the
+           (index, deserialized item) pairs the hook accepted, and errors for
+           the rest.'''
+        if not isinstance(items, list):
+            return None, None
+        before_hook = getattr(cls, 'before_{:s}'.format(action))
+        accepted, errors = [], []
+        for index, item in enumerate(items):
+            if action != 'destroy' and not isinstance(item, dict):
+                errors.append(bulk_error(index, 400,\
+                        'Expected a JSON object.'))
+                continue
+            item_id = resource_id
+            if resource_id == '_id': # the item names its own resource
+                item_id = item.get('_id') if isinstance(item, dict) else item
+            params = assemble_params(cls, action, item_id, request,\
+                    ancestor_ids)
+            params['request_data'] = item
+            before_hook(params) # before hook, per item
+            if params['status_code'] > 399:
+                errors.append(bulk_error(index, params['status_code'],\
+                        params.get('resp', 'Rejected by before_{:s}'.\
+                        format(action))))
+                continue
+            try:
+                accepted.append((index, deserialize(item)))
+            except InvalidId as error:
+                errors.append(bulk_error(index, 400, error))
+        return accepted, errors
+
+    @staticmethod
+    def _bulk_reindex(accepted, errors):
+        '''Map errors on the accepted items back to request positions.'''
+        for error in errors:
+            error['index'] = accepted[error['index']][0]
+        return errors
+
+    @classmethod
+    def _bulk_response(cls, package, errors):
+        '''Respond 200 if every item succeeded, 207 if some did not.'''
+        package['errors'] = sorted(errors, key=lambda e: e['index'])
+        return (cls._to_response(package), 207 if errors else 200, {})
     # -------------- END CONTROLLER METHODS --------------------------
 
     # -------------- HOOK METHODS ------------------------------------
@@ -253,15 +818,36 @@ class Pyro(object, metaclass=PyroMeta):
     @staticmethod
     def after_destroy(params):
         pass
+
+    @staticmethod
+    def before_upsert(params):
+        pass
+
+    @staticmethod
+    def after_upsert(params):
+        pass
     # -------------- END HOOK METHODS--------------------------------
 
     @classmethod
     def new(cls, doc, parent_instance=None):
         '''Create a new object, but do not save to database.'''
-        cls._doc = deserialize(doc)
-        obj = cls(cls._doc)
+        # deserialize hands back untouched dicts as-is; don't alias caller's.
+        return cls._instantiate(dict(deserialize(doc)), parent_instance)
+
+    @classmethod
+    def _from_db(cls, doc):
+        '''Create an object from a document fetched from Mongo. Stored keys
+           are already in their final form, so they are not deserialized.'''
+        obj = cls._instantiate(doc)
+        obj._mark_saved()
+        return obj
+
+    @classmethod
+    def _instantiate(cls, doc, parent_instance=None):
+        '''Wrap doc in an object, running the new-model hooks.'''
+        obj = cls(doc)
         obj.before_new_model()
-        cls.validate_associations(cls._doc, parent_instance)
+        cls.validate_associations(obj._doc, parent_instance)
         obj.after_new_model()
         return obj
 
@@ -272,6 +858,146 @@ class Pyro(object, metaclass=PyroMeta):
         obj.save()
         return obj
 
+    @classmethod
+    def upsert(cls, doc, parent_instance=None):
+        '''Update the document whose upsert key (see upserts_on) matches
+           doc's, or create it, with a single find_one_and_update. The save
+           hooks run either way. Returns the object, as stored.'''
+        if cls._upsert_key is None:
+            raise ValueError('{:s} declares no upsert key; see upserts_on.'.\
+                    format(cls.__name__))
+        obj = cls.new(doc, parent_instance=parent_instance)
+        obj.before_save_model() # before hook
+        query, update = obj._prepare_upsert()
+        try:
+            stored = upsert_document(cls._collection(), query, update)
+        except DuplicateKeyError:
+            obj._reject_foreign_upsert()
+            raise
+        obj._refresh(stored)
+        obj._mark_saved()
+        cls._uncache(obj._id)
+        # The upsert stamps both with the same time only if it inserted.
+        cls._announce('create' if stored['createdAt'] == stored['updatedAt']\
+                else 'update', [obj])
+        obj.after_save_model() # after hook
+        obj._finally()
+        return obj
+
+    @classmethod
+    def create_many(cls, docs, parent_instance=None):
+        '''Create many instances and save them with a single insert_many.
+
+        Model hooks run for every item. Returns (objects, errors), where
+        errors describe the docs that failed by their index in docs.
+        '''
+        objs, errors = [], []
+        for index, doc in enumerate(docs):
+            try:
+                obj = cls.new(doc, parent_instance=parent_instance)
+            except (ValueError, TypeError) as error:
+                errors.append(bulk_error(index, 400, error))
+                continue
+            obj.before_save_model() # before hook
+            obj._prepare_insert()
+            objs.append((index, obj))
+        collection = cls._collection()
+        failed = bulk_write_errors(collection.insert_many,\
+                [obj._doc for _, obj in objs])
+        created = []
+        for position, (index, obj) in enumerate(objs):
+            if position in failed:
+                errors.append(bulk_error(index, 400, failed[position]))
+                continue
+            obj._mark_saved()
+            obj.after_save_model() # after hook
+            obj._finally()
+            created.append(obj)
+        cls._announce('create', created)
+        return created, errors
+
+    @classmethod
+    def update_many(cls, docs):
+        '''Apply many partial updates (each doc carries its _id) in a single
+           bulk_write. Returns (objects, errors), as create_many does.'''
+        docs = [doc if isinstance(doc, dict) else {} for doc in docs]
+        objs, errors = cls._load_many([doc.get('_id') for doc in docs])
+        requests, pending = [], []
+        for index, doc in enumerate(docs):
+            obj = objs[index]
+            if obj is None:
+                continue
+            fields = dict((k, v) for k, v in doc.items() if k != '_id')
+            try:
+                obj._doc.update(deserialize(fields))
+            except InvalidId as error:
+                errors.append(bulk_error(index, 400, error))
+                continue
+            obj.before_update_model() # before hook
+            requests.append(UpdateOne(*obj._prepare_update()))
+            pending.append((index, obj))
+        failed, matched = bulk_update(cls._collection(), requests)
+        cls._uncache(*[obj._id for _, obj in pending])
+        missing = set()
+        if matched < len(requests) - len(failed): # deleted since we loaded
+            ids = [obj._id for _, obj in pending]
+            present = cls._collection().find({'_id': {'$in': ids}}, {'_id': 1})
+            missing = set(ids) - set(doc['_id'] for doc in present)
+        updated = []
+        for position, (index, obj) in enumerate(pending):
+            if position in failed:
+                errors.append(bulk_error(index, 400, failed[position]))
+                continue
+            if obj._id in missing:
+                errors.append(bulk_error(index, 404, 'Resource not found.'))
+                continue
+            obj._mark_saved()
+            obj.after_update_model() # after hook
+            obj._finally()
+            updated.append(obj)
+        cls._announce('update', updated)
+        return updated, errors
+
+    @classmethod
+    def delete_many(cls, ids):
+        '''Delete many documents by _id with a single delete_many. Returns
+           (objects, errors), as create_many does.'''
+        ids = [item.get('_id') if isinstance(item, dict) else item\
+                for item in ids]
+        objs, errors = cls._load_many(ids)
+        doomed = []
+        for obj in objs:
+            if obj is None:
+                continue
+            obj.before_delete_model() # before hook
+            doomed.append(obj)
+        if doomed:
+            collection = cls._collection()
+            collection.delete_many({'_id': {'$in': [o._id for o in doomed]}})
+            cls._uncache(*[obj._id for obj in doomed])
+            cls._bury(doomed)
+            cls._announce('delete', doomed)
+        for obj in doomed:
+            obj.after_delete_model() # after hook
+        return doomed, errors
+
+    @classmethod
+    def _load_many(cls, ids):
+        '''Fetch objects for ids in one query. Returns a list aligned with
+           ids (None where an id is malformed or absent) and the errors.'''
+        object_ids = [ObjectId(_id) if ObjectId.is_valid(_id) else None\
+                for _id in ids]
+        query = {'_id': {'$in': [_id for _id in object_ids if _id]}}
+        found = dict((doc['_id'], doc) for doc in cls.find_where(query))
+        objs, errors = [], []
+        for index, _id in enumerate(object_ids):
+            if _id is None:
+                errors.append(bulk_error(index, 400, 'Invalid _id.'))
+            elif _id not in found:
+                errors.append(bulk_error(index, 404, 'Resource not found.'))
+            objs.append(cls._from_db(found[_id]) if _id in found else None)
+        return objs, errors
+
     @classmethod
     def validate_associations(cls, doc, parent_instance):
         '''Ensure that has_many relationships are working.'''
@@ -282,49 +1008,290 @@ class Pyro(object, metaclass=PyroMeta):
                 return doc
         elif parent_instance.__class__ is cls._parent: # assign now
             doc[parent_instance._foreign_key()] = parent_instance._id
+            parent_instance.invalidate_associations(cls._plural_name)
             return doc
         error = ('This class must belong to an instance of the {:s} class').\
                 format(snake_to_class(cls._parent._singular_name))
         raise ValueError(error)
 
     @classmethod
-    def all(cls):
+    def count(cls, query=None, ancestry=None):
+        '''Count the documents matching query. Without one, the count comes
+           from collection metadata: fast, though it can briefly be off after
+           an unclean shutdown or on a sharded cluster. With an ancestry, as
+           for find_where, nothing is counted unless its ancestors belong to
+           one another.'''
+        if ancestry:
+            query = cls._owned(query, ancestry)
+            if query is None:
+                return 0
+        if not query:
+            return cls._collection().estimated_document_count()
+        return cls._collection().count_documents(query)
+
+    @classmethod
+    def aggregate(cls, query=None, group_by=(), ancestry=None, **stats):
+        '''Count the documents matching query per distinct value of the
+           group_by fields, along with statistics over other fields, all
+           computed by Mongo. For example,
+
+               Book.aggregate(group_by=['genre'], avg=['rating'])
+
+           returns [{'genre': 'sea', 'count': 3, 'avg': {'rating': 4.8}}, ...].
+           Statistics are sum, avg, min and max; fields are stored keys.
+           ancestry is as for find_where.'''
+        pipeline = aggregate_pipeline(query or {}, list(group_by), stats)
+        stages = cls._ownership_stages(ancestry or [], '_parent')
+        if stages: # checked once per group, after grouping
+            pipeline[1]['$group']['_parent'] =\
+                    {'$first': '$' + cls._parent._foreign_key()}
+            pipeline[2:2] = stages
+        return [aggregate_result(doc, group_by, stats)\
+                for doc in cls._collection().aggregate(pipeline)]
+
+    @classmethod
+    def all(cls, include=None, fields=None):
         '''Return a list of all documents associated with this object.'''
-        collection = cls._db[cls._plural_name]
-        return list(collection.find())
+        return cls.find_where({}, include, fields)
+
+    @classmethod
+    def find_page(cls, query=None, limit=None, after=None, include=None,\
+            fields=None, sort=None, ancestry=None):
+        '''Return a page of docs ordered by _id, plus the next page's cursor.
+           Pages sorted on other fields have no cursor; after needs _id order.
+           ancestry is as for find_where.'''
+        if sort and after is not None:
+            raise ValueError('after cannot be combined with sort')
+        query = cls._owned(query, ancestry)
+        if query is None:
+            return [], None
+        fetch = limit + 1 if limit is not None else None
+        docs = list(find_page(cls._collection(), query, fetch, after,\
+                projection=cls._projection(fields), sort=sort))
+        next_cursor = None
+        if limit is not None and len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = None if sort else str(docs[-1]['_id'])
+        return cls.with_related(docs, include), next_cursor
+
+    @classmethod
+    def iter_where(cls, query=None, after=None, limit=None, include=None,\
+            fields=None, sort=None, chunk_size=500, ancestry=None):
+        '''Lazily iterate over docs satisfying query, ordered by _id.
+           ancestry is as for find_where.'''
+        query = cls._owned(query, ancestry)
+        if query is None:
+            return iter([])
+        cursor = find_page(cls._collection(), query, limit, after,\
+                chunk_size, projection=cls._projection(fields), sort=sort)
+        if not include:
+            return cursor
+        # Sideload a chunk at a time so memory stays bounded.
+        return (doc for chunk in chunked(cursor, chunk_size)\
+                for doc in cls.with_related(chunk, include))
+
+    @classmethod
+    def changes_since(cls, since, query=None, limit=None, include=None,\
+            fields=None, ancestry=None):
+        '''The change feed of a model that tracks_changes: its documents
+        matching query that were created or updated at or after the
+        watermark since (a datetime or an ISO 8601 string; all of them, if
+        since is empty), the _ids of those deleted since, and the watermark
+        to ask from next time.
+
+        Returns {'changed': docs, 'deleted': _ids, 'watermark': ..., 'more':
+        bool}, oldest changes first. With a limit, each list stops after that
+        many and more is True; ask again from the watermark for the rest. The
+        watermark is a string: a time, or (after a limit) where each list
+        stopped, so documents sharing a timestamp are paged through by _id.
+        Changes close to the watermark come again in the next batch, so
+        clients should merge what they get by _id. Documents whose updatedAt
+        is not a date yet (see migrate_timestamps) are left out. ancestry is
+        as for find_where.
+        '''
+        if not cls._tracks_changes:
+            raise ValueError('{:s} keeps no change feed; see tracks_changes.'.\
+                    format(cls.__name__))
+        changed_from, deleted_from = parse_watermark(since)
+        query, buried = cls._owned(query, ancestry), {}
+        if query is not None and cls._parent is not None\
+                and cls._parent._foreign_key() in query:
+            foreign_key = cls._parent._foreign_key()
+            buried[foreign_key] = query[foreign_key]
+        projection = cls._projection(fields)
+        if projection is not None:
+            projection['updatedAt'] = 1
+        fetch = limit + 1 if limit is not None else None
+        docs, tombstones = [], []
+        if query is not None: # else the ancestors do not belong together
+            docs = list(find_page(cls._collection(),\
+                    feed_query(query, 'updatedAt', changed_from), fetch,\
+                    projection=projection, sort=[('updatedAt', ASCENDING)]))
+            tombstones = list(find_page(cls._tombstones(),\
+                    feed_query(buried, 'deletedAt', deleted_from), fetch,\
+                    sort=[('deletedAt', ASCENDING)]))
+        settled = (utc_now() - timedelta(seconds=cls.sync_lag), None)
+        more, positions = False, []
+        for items, stamp, start in [(docs, 'updatedAt', changed_from),\
+                (tombstones, 'deletedAt', deleted_from)]:
+            position = settled # never behind where this batch started
+            if start[0] is not None:
+                position = max(start, settled, key=feed_position)
+            if limit is not None and len(items) > limit:
+                del items[limit:] # the rest wait for the next batch
+                # resume after the last one sent
+                position = min(position, (items[-1][stamp], items[-1]['_id']),\
+                        key=feed_position)
+                more = True
+            positions.append(position)
+        watermark = format_watermark(*positions)
+        return {'changed': cls.with_related(docs, include),\
+                'deleted': [tombstone['_id'] for tombstone in tombstones],\
+                'watermark': watermark, 'more': more}
 
     @classmethod
     def delete_all(cls):
         '''Return a list of all documents associated with this object.'''
-        collection = cls._db[cls._plural_name]
-        return collection.delete_many({})
+        collection = cls._collection()
+        if cls._cache is not None:
+            cls._cache.clear(collection.full_name + ':')
+        result = collection.delete_many({})
+        cls._announce('reset')
+        return result
 
     @classmethod
     def to_objects(cls, cursor):
         '''Convert the output of a query into a list of objects.'''
-        return [cls.new(doc) for doc in cursor]
+        return [cls._from_db(doc) for doc in cursor]
 
     @classmethod
     def _to_response(cls, package):
         '''Convert the output of a data package into a JSON object.'''
-        return jsonify(serialize(package))
+        start = time.perf_counter()
+        body = encode(package)
+        record_serialization(time.perf_counter() - start)
+        return Response(body, mimetype='application/json')
+
+    @classmethod
+    def _conditional_response(cls, package, include=None):
+        '''Respond with package, or with 304 Not Modified if the client's
+           If-None-Match/If-Modified-Since shows its copy is current. The
+           check runs on _id/updatedAt alone, before anything is serialized.'''
+        etag, last_modified = validators(package, include or (),\
+                request.query_string)
+        if not_modified(request, etag, last_modified):
+            resp = Response(status=304)
+        else:
+            resp = cls._to_response(package)
+        return cache_headers(resp, etag, last_modified, cls.cache_control)
 
     @classmethod
-    def find_where(cls, query):
-        '''Find docs in collection satisfying query.'''
-        collection = cls._db[cls._plural_name]
-        return list(collection.find(query))
+    def find_where(cls, query, include=None, fields=None, ancestry=None):
+        '''Find docs in collection satisfying query. Given a nested route's
+           ancestry ((model, _id) pairs, parent first), only the parent's docs
+           are found, and none unless each ancestor belongs to the next one
+           up.'''
+        query = cls._owned(query, ancestry)
+        if query is None:
+            return []
+        docs = list(cls._collection().find(query, cls._projection(fields)))
+        return cls.with_related(docs, include)
 
     @classmethod
-    def find_by_id(cls, _id):
+    def _projection(cls, fields):
+        '''Build a projection from a list of fields (or a projection dict).
+           The parent's foreign key always comes along: objects can't be
+           built, nor parents sideloaded, without it.'''
+        if fields is None:
+            return None
+        projection = dict((field, 1) for field in fields)
+        if cls._parent is not None:
+            projection[cls._parent._foreign_key()] = 1
+        return projection
+
+    @classmethod
+    def with_related(cls, docs, include=None):
+        '''Sideload parent/children named in include onto a list of docs.
+
+        Each relation costs one query for the whole list: parents are fetched
+        with a single $in on the foreign key, children with a single $in on
+        the parents' _ids and then grouped in memory.
+        '''
+        for RelatedClass in cls._related_classes(include):
+            related = RelatedClass.find_where(\
+                    cls._related_query(docs, RelatedClass))
+            cls._attach_related(docs, RelatedClass, related)
+        return docs
+
+    @classmethod
+    def _related_classes(cls, include):
+        '''Map relation names (parent singular, child plural) to classes.'''
+        related = dict((child._plural_name, child) for child in cls._children)
+        if cls._parent is not None:
+            related[cls._parent._singular_name] = cls._parent
+        classes = []
+        for name in include or []:
+            if name not in related:
+                error = ('{:s} is not related to {:s}').\
+                        format(name, snake_to_class(cls._singular_name))
+                raise ValueError(error)
+            classes.append(related[name])
+        return classes
+
+    @classmethod
+    def _related_query(cls, docs, RelatedClass):
+        '''The one query that finds the parents (or children) of all docs.'''
+        if RelatedClass is cls._parent:
+            foreign_key = RelatedClass._foreign_key()
+            parent_ids = list(set(doc[foreign_key] for doc in docs\
+                    if foreign_key in doc))
+            return {'_id': {'$in': parent_ids}}
+        return {cls._foreign_key(): {'$in': [doc['_id'] for doc in docs]}}
+
+    @classmethod
+    def _attach_related(cls, docs, RelatedClass, related):
+        '''Attach to each doc its parent (or children) from related, the
+           documents found by _related_query.'''
+        if RelatedClass is cls._parent:
+            foreign_key = RelatedClass._foreign_key()
+            parents = dict((parent['_id'], parent) for parent in related)
+            for doc in docs:
+                doc[RelatedClass._singular_name] =\
+                        parents.get(doc.get(foreign_key))
+            return
+        foreign_key = cls._foreign_key()
+        children = dict((doc['_id'], []) for doc in docs)
+        for child in related:
+            children[child[foreign_key]].append(child)
+        for doc in docs:
+            doc[RelatedClass._plural_name] = children[doc['_id']]
+
+    @classmethod
+    def find_by_id(cls, _id, fields=None, ancestry=None):
+        '''The object with the given _id, or False. Given the ancestry of a
+           nested route ((model, _id) pairs, parent first), the object is
+           only found if it belongs to the parent, the parent to the
+           grandparent, and so on, all checked in one aggregation.'''
         _id = ObjectId(_id)
-        doc = find_document(_id, cls._db[cls._plural_name])
+        if ancestry:
+            query = {'_id': _id, cls._parent._foreign_key(): ancestry[0][1]}
+            pipeline = [{'$match': query}] + cls._ownership_stages(ancestry)
+            projection = cls._projection(fields)
+            if projection is not None:
+                pipeline.append({'$project': projection})
+            doc = next(cls._collection().aggregate(pipeline), None)
+        elif cls._cache is not None and fields is None: # read through cache
+            doc, generation = cls._cached(_id)
+            if doc is None:
+                doc = find_document(_id, cls._collection())
+                cls._cache_doc(_id, doc, generation)
+        else:
+            doc = find_document(_id, cls._collection(),\
+                    cls._projection(fields))
         if doc is None:
             return False
         else:
-            obj = cls.new(doc)
-            obj._finally()
-            return obj
+            return cls._from_db(doc)
 
     @classmethod
     def _foreign_key(cls):
@@ -336,24 +1303,142 @@ class Pyro(object, metaclass=PyroMeta):
         '''Specify a one-to-many relationship between data models.'''
         child_class._parent = cls
         cls._children.append(child_class)
+        # Nested routes and child queries filter on the foreign key.
+        child_class.has_index(cls._foreign_key())
+        for field in child_class._timestamp_indexes: # and time ranges
+            child_class.has_index([cls._foreign_key(), field])
+        # Associations are loaded lazily, on first access.
+        setattr(child_class, cls._singular_name, LazyParent(cls))
+        setattr(cls, child_class._plural_name, LazyChildren(child_class))
+
+    @classmethod
+    def _ancestry(cls, resource_id, ancestor_ids):
+        '''The (model, _id) pairs a nested route names, parent first: the
+           parent's _id is its resource_id, and ancestor_ids hold the rest,
+           under their foreign keys.'''
+        ancestry = []
+        Ancestor, _id = cls._parent, resource_id
+        while Ancestor is not None and _id:
+            ancestry.append((Ancestor, ObjectId(_id)))
+            Ancestor = Ancestor._parent
+            if Ancestor is not None:
+                _id = ancestor_ids.get(Ancestor._foreign_key())
+        return ancestry
+
+    @classmethod
+    def _find_parent(cls, resource_id, ancestor_ids):
+        '''The parent a nested route names, or False if there is none, or it
+           does not belong to the ancestors named above it.'''
+        ancestry = cls._ancestry(resource_id, ancestor_ids)
+        return cls._parent.find_by_id(resource_id, ancestry=ancestry[1:])
+
+    @classmethod
+    def _owned(cls, query, ancestry):
+        '''query, restricted to the children of the parent at the head of a
+           nested route's ancestry; None if the ancestors do not belong to one
+           another. The chain is checked once, by _id on the parent, so the
+           query itself stays an indexed find on this model's collection.'''
+        query = dict(query or {})
+        if not ancestry:
+            return query
+        (_, parent_id), owners = ancestry[0], ancestry[1:]
+        if owners and not cls._parent.find_by_id(parent_id, fields=['_id'],\
+                ancestry=owners):
+            return None
+        foreign_key = cls._parent._foreign_key()
+        if query.get(foreign_key, parent_id) != parent_id:
+            return {'$and': [query, {foreign_key: parent_id}]}
+        query[foreign_key] = parent_id
+        return query
+
+    @classmethod
+    def _ownership_stages(cls, ancestry, local_field=None):
+        '''Aggregation stages that keep documents only if the ancestors in
+           ancestry ((model, _id) pairs, parent first) belong to one another:
+           the parent to the grandparent, and so on up. Each level is an _id
+           lookup along the foreign keys; local_field holds the parent's _id
+           (by default, the foreign key). That documents belong to the parent
+           is for the query to say.'''
+        if len(ancestry) < 2:
+            return []
+        stages, names = [], []
+        local_field = local_field or cls._parent._foreign_key()
+        for (Ancestor, _), (Owner, owner_id) in zip(ancestry, ancestry[1:]):
+            name = '_ancestor{:d}'.format(len(names))
+            names.append(name)
+            owner_key = '{:s}.{:s}'.format(name, Owner._foreign_key())
+            stages += [{'$lookup': {'from': Ancestor._collection().name,\
+                    'localField': local_field, 'foreignField': '_id',\
+                    'as': name}}, {'$unwind': '$' + name},\
+                    {'$match': {owner_key: owner_id}}]
+            local_field = owner_key
+        return stages + [{'$project': dict.fromkeys(names, 0)}]
+
+    @classmethod
+    def _association_names(cls):
+        '''Attribute names under which parent/children are attached.'''
+        names = [ChildClass._plural_name for ChildClass in cls._children]
+        if cls._parent is not None:
+            names.append(cls._parent._singular_name)
+        return names
 
     def __init__(self, doc):
-        '''Consume a document and attach attributes as properties.'''
-        self.__dict__.update(doc)
-
-    def _find_parent(self):
-        '''Find and attach parent.'''
-        if self.has_parent:
-            ParentClass = self._parent
-            foreign_key = ParentClass._foreign_key()
-            parent_obj = ParentClass.find_by_id(self.__dict__[foreign_key])
-            self.__dict__[ParentClass._singular_name] = parent_obj
-
-    def _find_children(self):
-        '''Find and attach parent.'''
-        for ChildClass in self._children:
-            self.__dict__[ChildClass._plural_name] = ForeignQuery(self,\
-                    ChildClass)
+        '''Adopt a document as the instance's attributes, without copying:
+           setting or deleting an attribute sets or removes the field.'''
+        self.__dict__ = doc
+        self._saved = {} # the document as last loaded or saved, in brief
+        self._related = None # parent/children, as loaded on first access
+
+    @property
+    def _doc(self):
+        '''The document, which holds the instance's attributes.'''
+        return self.__dict__
+
+    @_doc.setter
+    def _doc(self, doc):
+        self.__dict__ = doc
+
+    def invalidate_associations(self, *names):
+        '''Forget cached parent/children so they are re-queried on access.'''
+        if self._related is None:
+            return
+        for name in names or self._association_names():
+            self._related.pop(name, None)
+
+    def _sync_doc(self):
+        '''Drop parents/children assigned as attributes from the document,
+           which is bound for Mongo.'''
+        return self._strip_associations(self._doc)
+
+    def _mark_saved(self):
+        '''Remember the document as it now stands in Mongo. Lists and dicts
+           are remembered by fingerprint rather than copied, so changes made
+           to them in place still show up as changes.'''
+        self._saved = dict((key, fingerprint(value)\
+                if type(value) in (dict, list) else value)\
+                for key, value in self._doc.items())
+
+    def _changes(self):
+        '''Fields changed since the document was loaded or saved: a dict of
+           those to $set and a list of those to $unset.'''
+        saved = self._saved
+        changed = {}
+        for key, value in self._doc.items():
+            if key not in saved:
+                changed[key] = value
+            elif type(value) in (dict, list):
+                if fingerprint(value) != saved[key]:
+                    changed[key] = value
+            elif type(value) is not type(saved[key]) or value != saved[key]:
+                changed[key] = value
+        removed = [key for key in saved if key not in self._doc]
+        return changed, removed
+
+    def _strip_associations(self, doc):
+        '''Remove cached parent/children from a document bound for Mongo.'''
+        for name in self._association_names():
+            doc.pop(name, None)
+        return doc
 
     @property
     def has_parent(self):
@@ -361,58 +1446,152 @@ class Pyro(object, metaclass=PyroMeta):
         return self._parent is not None
 
     def save(self):
-        '''Save the current document, if there is one.'''
-        self._doc.update(self.__dict__)
-        if self.has_parent:
-            if self._parent._singular_name in self._doc:
-                del self._doc[self._parent._singular_name]
+        '''Save the current document, if there is one. An existing document
+           only has its changed fields written.'''
+        self._sync_doc()
         if self.doc_exists:
             self._update_existing_doc()
         else:
             self._save_new_doc()
         self._finally()
 
+    def modify(self, operators):
+        '''Save the document's changes together with update operators, which
+           Mongo applies atomically, e.g.
+
+               post.modify({'$inc': {'views': 1}, '$push': {'tags': 'new'}})
+
+           The object is then refreshed from the stored document. Returns
+           False if the document no longer exists.'''
+        self._sync_doc()
+        if not self.doc_exists:
+            raise ValueError('Only saved documents can be modified.')
+        found = self._update_existing_doc(operators)
+        self._finally()
+        return found
+
     def _finally(self):
-        '''Clean up, sideload parents/children/etc.'''
-        self._find_parent()
-        self._find_children()
+        '''Clean up; foreign keys may have changed, so drop cached relations.'''
+        self.invalidate_associations()
 
     def _save_new_doc(self):
         '''Save new document to the database.'''
         self.before_save_model() # before hook
-        self._doc['createdAt'] = str(datetime.now())
-        self._doc['updatedAt'] = str(datetime.now())
-        response = self._db[self._plural_name].insert_one(self._doc)
-        self._doc['_id'] = response.inserted_id
-        self.__dict__.update(self._doc)
+        self._prepare_insert()
+        response = self._collection().insert_one(self._doc)
+        self._inserted(response.inserted_id)
         self.after_save_model() # after hook
 
-    def _update_existing_doc(self):
-        '''Update an existing document.'''
+    def _update_existing_doc(self, operators=None):
+        '''Update an existing document, writing only the fields that changed
+           (and any update operators). Returns False if it no longer
+           exists.'''
         self.before_update_model() # before hook
-        self._doc['updatedAt'] = str(datetime.now())
-        self._doc.update(self.__dict__)
-        self._doc = clean_document(self._doc)
-        if self.has_parent:
-            if self._parent._singular_name in self._doc:
-                del self._doc[self._parent._singular_name]
-        update_document(self._doc, self._db[self._plural_name])
+        query, update = self._prepare_update(operators)
+        if operators: # Mongo computes the result; read it back
+            doc = self._collection().find_one_and_update(query, update,\
+                    return_document=ReturnDocument.AFTER)
+            found = doc is not None
+        else:
+            doc, found = None, self._collection().update_one(query, update).\
+                    matched_count > 0
+        self._uncache(self._id)
+        self._updated(found, doc)
         self.after_update_model() # after hook
+        return found
+
+    def _inserted(self, inserted_id):
+        '''Take note of the document's insert.'''
+        self._doc['_id'] = inserted_id
+        self._mark_saved()
+        self._announce('create', [self])
+
+    def _updated(self, found, doc=None):
+        '''Take note of the document's update: found is whether it still
+           existed, doc what update operators made of it, read back.'''
+        if doc is not None:
+            self._refresh(doc)
+        self._mark_saved()
+        if found:
+            self._announce('update', [self])
+
+    def _prepare_insert(self):
+        '''Timestamp the document for insert.'''
+        self._sync_doc()
+        self._doc['createdAt'] = self._doc['updatedAt'] = utc_now()
+        return self._doc
+
+    def _prepare_update(self, operators=None):
+        '''Timestamp the document and return the (filter, update) pair that
+           writes back what has changed since it was loaded or saved.'''
+        self._sync_doc()
+        self.updatedAt = utc_now()
+        changed, removed = self._changes()
+        changed['updatedAt'] = self.updatedAt # even if in the same millisecond
+        update = {'$set': changed}
+        if removed:
+            update['$unset'] = dict.fromkeys(removed, '')
+        if operators:
+            update = with_operators(update, operators)
+        return qry(self._doc), update
+
+    def _prepare_upsert(self):
+        '''Return the (filter, update) pair that upserts the document on the
+           upsert key, within its parent's documents.'''
+        self._sync_doc()
+        # {field: None} would match every document that lacks the field
+        missing = [field for field in self._upsert_key\
+                if self._doc.get(field) is None]
+        if missing:
+            raise ValueError('Upserts need {:s}.'.format(\
+                    ', '.join(snake_to_camel(field) for field in missing)))
+        now = utc_now()
+        query = dict((field, self._doc[field]) for field in self._upsert_key)
+        if self._parent is not None: # never one of another parent's
+            foreign_key = self._parent._foreign_key()
+            query[foreign_key] = self._doc.get(foreign_key)
+        fields = dict((key, value) for key, value in self._doc.items()\
+                if key not in ('_id', 'createdAt'))
+        fields['updatedAt'] = now
+        return query, {'$set': fields, '$setOnInsert': {'createdAt': now}}
+
+    def _reject_foreign_upsert(self):
+        '''Raise ValueError if the upsert key is taken by a document that
+           belongs to another parent.'''
+        if self._parent is None:
+            return
+        foreign_key = self._parent._foreign_key()
+        query = dict((field, self._doc[field]) for field in self._upsert_key)
+        taken = self._collection().find_one(query, {foreign_key: 1})
+        if taken is not None and taken.get(foreign_key) !=\
+                self._doc.get(foreign_key):
+            raise ValueError('The {:s} with this {:s} belongs to another '\
+                    '{:s}.'.format(snake_to_class(self._singular_name),\
+                    ', '.join(snake_to_camel(f) for f in self._upsert_key),\
+                    snake_to_class(self._parent._singular_name)))
+
+    def _refresh(self, doc):
+        '''Adopt doc, as just read back from Mongo, as this object's state.'''
+        self._doc = doc
 
     def delete(self):
         '''Delete the current document.'''
         self.before_delete_model() # before hook
-        collection = self._db[self._plural_name]
+        collection = self._collection()
         collection.delete_one(qwrap(self._id))
+        self._uncache(self._id)
+        self._bury([self])
+        self._announce('delete', [self])
         self.after_delete_model() # after hook
 
     def serialize(self, include_children=False):
         '''Prepare document for transport over HTTP.'''
         doc = self._doc
-        if include_children:
+        if include_children: # on a copy, so they are never saved
+            doc = dict(doc)
             for ChildClass in self._children:
                 child_name = ChildClass._plural_name
-                doc[child_name] = self.__dict__[child_name]()
+                doc[child_name] = getattr(self, child_name)()
         return serialize(doc)
 
     @property
@@ -451,3 +1630,8 @@ class Pyro(object, metaclass=PyroMeta):
     def after_save_model(self):
         '''Override to add functionality.'''
         pass
+
+
+if hasattr(os, 'register_at_fork'):
+    # A forked child must not share its parent's sockets or monitor threads.
+    os.register_at_fork(after_in_child=Pyro._reattach_db)
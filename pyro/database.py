@@ -1,23 +1,79 @@
 '''Routines for dealing with Mongo databases.'''
-import numpy as np
 from bson import ObjectId
-import numpy as np
+from bson.errors import InvalidId
+import os
+import threading
 import time
-from pymongo import MongoClient
-import logging
-from ipdb import set_trace as debug
+from pymongo import MongoClient, UpdateOne, IndexModel, ASCENDING,\
+        ReturnDocument
+from pymongo.errors import BulkWriteError, ConnectionFailure,\
+        DuplicateKeyError, OperationFailure
+from pyro.metrics import command_timer
+from pyro.utils import parse_timestamp
 
 
-def connect_to_database(database_name='dev'):
+# Shared clients, keyed by (uri, options). Each holds a connection pool, so
+# a process should only ever need one per server.
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(uri=None, **options):
+    '''Return this process's pooled MongoClient for uri and options.'''
+    key = (uri, repr(sorted(options.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = MongoClient(uri, **timed(options))
+        return _clients[key]
+
+
+def get_async_client(uri=None, **options):
+    '''Return this process's asyncio client for uri and options: pymongo's
+       AsyncMongoClient, or motor's on pymongo releases without one.'''
+    key = (uri, repr(sorted(options.items())))
+    with _clients_lock:
+        if key not in _async_clients:
+            try:
+                from pymongo import AsyncMongoClient
+            except ImportError:
+                try:
+                    from motor.motor_asyncio import\
+                            AsyncIOMotorClient as AsyncMongoClient
+                except ImportError:
+                    raise ImportError('Async serving needs pymongo>=4.9 '\
+                            'or motor.')
+            _async_clients[key] = AsyncMongoClient(uri, **timed(options))
+        return _async_clients[key]
+
+
+def timed(options):
+    '''Client options, plus the listener that times every command.'''
+    listeners = list(options.get('event_listeners', [])) + [command_timer]
+    return dict(options, event_listeners=listeners)
+
+
+def forget_clients():
+    '''Drop all shared clients; the next get_client() creates new ones.'''
+    _clients.clear()
+    _async_clients.clear()
+
+
+def connect_to_database(database_name='dev', uri=None, **options):
     '''Establish a connection with the specified database.'''
     try:
-        client = MongoClient()
+        client = get_client(uri, **options)
         database = client[database_name]
-    except:
+    except ConnectionFailure:
         raise IOError('Cannot connect to Mongo DB. Is it running?')
     return database
 
 
+if hasattr(os, 'register_at_fork'):
+    # Clients (sockets, monitor threads) must never cross a fork() boundary.
+    os.register_at_fork(after_in_child=forget_clients)
+
+
 def created_at():
     '''Return a nice date/time string.'''
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
@@ -25,7 +81,7 @@ def created_at():
 
 def unix_time_in_microseconds():
     '''Return current POSIX epoch in microseconds, as a 64-bit integer.'''
-    return np.int64(time.time() * 1e6)
+    return int(time.time() * 1e6)
 
 
 def q(record):
@@ -58,10 +114,168 @@ def update_document(document, collection):
     return collection.update_one(query, {'$set': document}, upsert=False)
 
 
-def find_document(document_id, collection):
+def with_operators(update, operators):
+    '''Add update operators ({'$inc': {'views': 1}}, ...) to an update. An
+       operator may not touch a field the update already sets or unsets;
+       Mongo would reject the pair as conflicting.'''
+    written = set(field.split('.')[0] for fields in update.values()\
+            for field in fields)
+    update = dict((operator, dict(fields))\
+            for operator, fields in update.items())
+    for operator, fields in operators.items():
+        for field in fields:
+            if field.split('.')[0] in written:
+                raise ValueError('{:s} on {:s} conflicts with another '\
+                        'change to it.'.format(operator, field))
+        update.setdefault(operator, {}).update(fields)
+    return update
+
+
+def upsert_document(collection, query, update):
+    '''Update the document matching query, or insert one, and return it as
+       stored. When two upserts race to insert the same key, the unique index
+       turns one away; retried, it then matches the other's document.'''
+    for attempt in range(2):
+        try:
+            return collection.find_one_and_update(query, update,\
+                    upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            if attempt:
+                raise
+
+
+def server_message(error):
+    '''The message Mongo gave with a failed command or write.'''
+    return (error.details or {}).get('errmsg', str(error))
+
+
+def bulk_write_errors(write, requests):
+    '''Run an unordered bulk write; return {index: message} for failures.'''
+    if not requests:
+        return {}
+    try:
+        write(requests, ordered=False)
+    except BulkWriteError as error:
+        write_errors = error.details.get('writeErrors', [])
+        return dict((e['index'], e['errmsg']) for e in write_errors)
+    return {}
+
+
+def bulk_update(collection, requests):
+    '''Run unordered updates in one bulk_write. Returns {index: message} for
+       the failures and how many of the requests matched a document.'''
+    if not requests:
+        return {}, 0
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as error:
+        write_errors = error.details.get('writeErrors', [])
+        return dict((e['index'], e['errmsg']) for e in write_errors),\
+                error.details.get('nMatched', 0)
+    return {}, result.matched_count
+
+
+def migrate_timestamps(collection, fields, batch_size=1000):
+    '''Rewrite the fields of documents that hold timestamp strings (local
+       time, as older versions of Pyro wrote them) as UTC datetimes,
+       batch_size documents per bulk write. Returns how many were changed.'''
+    query = {'$or': [{field: {'$type': 'string'}} for field in fields]}
+    migrated, batch = 0, []
+    for doc in collection.find(query, dict.fromkeys(fields, 1)):
+        stamps = dict((field, parse_timestamp(doc.get(field)))\
+                for field in fields if isinstance(doc.get(field), str))
+        update = dict((field, stamp.replace(tzinfo=None))\
+                for field, stamp in stamps.items() if stamp is not None)
+        if update: # unreadable strings are left as they are
+            batch.append(UpdateOne(qwrap(doc['_id']), {'$set': update}))
+        if len(batch) == batch_size:
+            migrated += collection.bulk_write(batch, ordered=False).\
+                    modified_count
+            batch = []
+    if batch:
+        migrated += collection.bulk_write(batch, ordered=False).modified_count
+    return migrated
+
+
+def index_model(spec):
+    '''Turn an index declaration into a pymongo IndexModel.'''
+    options = {}
+    if spec['unique']:
+        options['unique'] = True
+    if spec['ttl'] is not None:
+        options['expireAfterSeconds'] = spec['ttl']
+    if spec.get('partial') is not None:
+        options['partialFilterExpression'] = spec['partial']
+    return IndexModel(spec['keys'], **options)
+
+
+def ensure_indexes(collection, specs):
+    '''Create any declared indexes that don't exist yet, in one command.'''
+    if not specs:
+        return []
+    return collection.create_indexes([index_model(spec) for spec in specs])
+
+
+def index_keys(collection):
+    '''Map each existing index name to its key pattern.'''
+    return dict((name, [(k, int(d)) if isinstance(d, float) else (k, d)\
+            for k, d in info['key']])\
+            for name, info in collection.index_information().items())
+
+
+def index_usage(collection):
+    '''Map index names to how often they have been used since the server
+       started, or return None if $indexStats is unavailable.'''
+    try:
+        stats = collection.aggregate([{'$indexStats': {}}])
+        return dict((s['name'], s['accesses']['ops']) for s in stats)
+    except (OperationFailure, NotImplementedError):
+        return None
+
+
+def find_document(document_id, collection, projection=None):
     ''' Find a document in a collection given a document_id.'''
     query = {'_id': string_to_obj(document_id)}
-    return collection.find_one(query)
+    return collection.find_one(query, projection)
+
+
+def keyset_query(query, after=None):
+    '''Restrict a query to documents whose _id follows the after cursor.'''
+    if after is None:
+        return query
+    after_clause = {'_id': {'$gt': string_to_obj(after)}}
+    if not query:
+        return after_clause
+    return {'$and': [query, after_clause]}
+
+
+def feed_query(query, field, position):
+    '''Restrict a query to the documents after a change feed position: a
+       (time, _id) pair, _id None if all of that millisecond is to come.
+       Only documents stamped with a date are in the feed; legacy string
+       stamps (see migrate_timestamps) cannot be ordered with them.'''
+    stamp, _id = position
+    if stamp is None: # from the beginning
+        clause = {field: {'$type': 'date'}}
+    elif _id is None:
+        clause = {field: {'$gte': stamp}}
+    else: # ties on the time are broken by _id
+        clause = {'$or': [{field: {'$gt': stamp}},\
+                {field: stamp, '_id': {'$gt': _id}}]}
+    if not query:
+        return clause
+    return {'$and': [query, clause]}
+
+
+def find_page(collection, query, limit=None, after=None, batch_size=500,\
+        projection=None, sort=None):
+    '''Return a cursor over query, ordered by _id (or by sort, with _id
+       breaking ties) and resuming after cursor.'''
+    cursor = collection.find(keyset_query(query, after), projection)
+    cursor = cursor.sort(list(sort or []) + [('_id', 1)])
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return cursor.batch_size(batch_size)
 
 
 def find_inserted_document(insertion_response, collection):
@@ -95,5 +309,3 @@ def serialize_mongo(result):
     else:
         out = goodify(result)
     return out
-
-
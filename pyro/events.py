@@ -0,0 +1,229 @@
+'''Push changes to models to their subscribers, for the /events routes
+(Server-Sent Events).
+
+Each model gets an EventBus the first time someone subscribes to it. Where
+Mongo offers change streams (replica sets and sharded clusters), a thread
+per model follows the collection's change stream and publishes every insert,
+update and delete, whichever process made it. Elsewhere Pyro announces the
+writes it makes itself, as it makes them, so subscribers only hear of writes
+made through this process.
+
+Subscribers buffer a bounded number of events. One that falls further behind
+is cut off; it reconnects with the id of the last event it saw (as browsers'
+EventSource does) and the events it missed are replayed from the bus's
+history, if they are still there, or it is told to start over (a reset
+event) if they are not.
+'''
+import collections
+import copy
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from pymongo.errors import PyMongoError
+from pyro.query import matches
+from pyro.utils import encode
+
+
+logger = logging.getLogger(__name__)
+
+# Change stream operations, as the events subscribers see. Drops and renames
+# leave subscribers' copies beyond repair: they must start over.
+CHANGE_KINDS = {'insert': 'create', 'update': 'update', 'replace': 'update',\
+        'delete': 'delete', 'drop': 'reset', 'rename': 'reset',\
+        'dropDatabase': 'reset', 'invalidate': 'reset'}
+RETRY_DELAY = 1.0 # seconds between attempts to reopen a failed change stream
+HEARTBEAT = b': keep-alive\n\n'
+# Sent first, so headers go out at once, telling clients how soon (in ms) to
+# reconnect if cut off.
+PREAMBLE = b'retry: 1000\n\n'
+# Keep caches and proxies (nginx buffers by default) from holding events.
+EVENT_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# The bus of each model that has had subscribers.
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+class Event(collections.namedtuple('Event', 'id kind doc_id doc data')):
+    '''A change to one document (or, for resets, to the whole collection).
+       doc is the document as stored, for matching subscribers' filters;
+       data is what they are sent.'''
+
+    def sse(self):
+        '''The event in the Server-Sent Events wire format.'''
+        lines = [b'event: ' + self.kind.encode(), b'data: ' + self.data]
+        if self.id is not None: # RESET has none: a client told to start
+            lines.insert(0, b'id: ' + self.id.encode()) # over keeps its id
+        return b'\n'.join(lines) + b'\n\n'
+
+
+def make_event(event_id, kind, _id=None, doc=None):
+    if kind == 'reset':
+        data = {}
+    elif kind == 'delete' or doc is None:
+        data = {'_id': _id}
+    else:
+        data = doc
+    return Event(event_id, kind, _id, doc, encode(data))
+
+
+RESET = make_event(None, 'reset')
+
+
+def event_filter(query):
+    '''Match events against a filter compiled by parse_filter. Resets, and
+       deletes a change stream reports without their documents, always
+       match.'''
+    def wanted(event):
+        return event.doc is None or matches(event.doc, query)
+    return wanted
+
+
+class Subscriber(object):
+    '''One client's bounded buffer of the events that match its filter.'''
+
+    def __init__(self, matches, size):
+        self.matches = matches # event -> bool
+        self.size = size
+        self.overflowed = False
+
+    def offer(self, event):
+        '''Buffer the event if it is wanted. Never blocks: a subscriber
+           whose buffer is full is marked overflowed instead.'''
+        if self.overflowed or not self.matches(event):
+            return
+        self._put(event)
+
+
+class ThreadSubscriber(Subscriber):
+    '''A subscriber served by a worker thread (Application).'''
+
+    def __init__(self, matches, size):
+        super(ThreadSubscriber, self).__init__(matches, size)
+        self.events = queue.Queue(size)
+
+    def _put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        '''The next event, or None if none came within timeout seconds.'''
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus(object):
+    '''Hands a model's events to its subscribers, keeping the latest few so
+       reconnecting subscribers can catch up.'''
+
+    def __init__(self, history=1000):
+        self.subscribers = set()
+        self.history = collections.deque(maxlen=history)
+        self.watching = False # fed by a change stream, not by announce
+        self._lock = threading.Lock()
+        # Ids of announced events are only meaningful to this bus.
+        self._epoch = os.urandom(4).hex()
+        self._sequence = itertools.count(1)
+
+    def publish(self, kind, _id=None, doc=None, event_id=None):
+        if event_id is None:
+            event_id = '{:s}-{:d}'.format(self._epoch, next(self._sequence))
+        event = make_event(event_id, kind, _id, doc)
+        with self._lock: # offers never block; holding the lock keeps order
+            self.history.append(event)
+            for subscriber in self.subscribers:
+                subscriber.offer(event)
+
+    def subscribe(self, subscriber, last_event_id=None):
+        '''Add a subscriber, replaying what it missed after last_event_id.
+           Returns False if those events are no longer held, in which case
+           the subscriber should be told to start over.'''
+        with self._lock:
+            self.subscribers.add(subscriber)
+            if last_event_id is None:
+                return True
+            ids = [event.id for event in self.history]
+            if last_event_id not in ids:
+                return False
+            for event in list(self.history)[ids.index(last_event_id) + 1:]:
+                subscriber.offer(event)
+            return True
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def watch(self, collection):
+        '''Feed the bus from the collection's change stream, if Mongo has
+           one to offer. Returns whether it does.'''
+        try:
+            stream = collection.watch(full_document='updateLookup')
+        except (PyMongoError, NotImplementedError, TypeError):
+            return False # a standalone server (or a stand-in for Mongo)
+        self.watching = True
+        thread = threading.Thread(target=self._follow,\
+                args=(collection, stream), daemon=True,\
+                name='pyro-events-{:s}'.format(collection.name))
+        thread.start()
+        return True
+
+    def _follow(self, collection, stream):
+        '''Publish the changes of a change stream, for ever, reopening it
+           after the last change seen if it fails.'''
+        token = None
+        while True:
+            try:
+                if stream is None:
+                    stream = collection.watch(full_document='updateLookup',\
+                            start_after=token)
+                with stream:
+                    for change in stream:
+                        token = change['_id']
+                        self._publish_change(change)
+            except PyMongoError as error:
+                logger.warning('Change stream on %s failed (%s); reopening',\
+                        collection.full_name, error)
+            stream = None
+            time.sleep(RETRY_DELAY)
+
+    def _publish_change(self, change):
+        kind = CHANGE_KINDS.get(change['operationType'])
+        if kind is None:
+            return
+        doc = change.get('fullDocument')
+        if kind == 'update' and doc is None:
+            return # deleted before the lookup; its delete event follows
+        _id = change.get('documentKey', {}).get('_id')
+        self.publish(kind, _id, doc, change['_id']['_data'])
+
+
+def bus_for(Model):
+    '''The model's bus, created (and its change stream opened, if there is
+       one) on first use.'''
+    with _buses_lock:
+        bus = _buses.get(Model)
+        if bus is None:
+            bus = _buses[Model] = EventBus(Model.event_buffer)
+            bus.watch(Model._collection())
+        return bus
+
+
+def announce(Model, kind, docs=()):
+    '''Publish writes Pyro has made, unless nobody is listening or a change
+       stream will report them. docs are as stored, and are copied, so they
+       may change after; a reset takes none.'''
+    bus = _buses.get(Model)
+    if bus is None or bus.watching:
+        return
+    if kind == 'reset':
+        bus.publish(kind)
+    for doc in docs:
+        bus.publish(kind, doc.get('_id'), copy.deepcopy(doc))
+
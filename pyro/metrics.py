@@ -0,0 +1,203 @@
+'''Where the time goes: request, Mongo and serialization timings, kept in
+process and rendered in Prometheus' text format.
+
+Application times each request by route. Every Mongo command is timed through
+pymongo's command monitoring (shared clients carry command_timer), and counted
+against the request that ran it, as is the time spent encoding its response.
+Requests slower than a threshold are logged with that breakdown.
+'''
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from pymongo import monitoring
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (le) of the histogram buckets, in seconds and in commands.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,\
+        1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    '''A Prometheus histogram, with one series per combination of labels.'''
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {} # label values -> [count per bucket..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] =\
+                        [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def series(self, *label_values):
+        '''(count, sum) of the observations with these label values.'''
+        with self._lock:
+            series = self._series.get(label_values)
+            return (sum(series[:-1]), series[-1]) if series else (0, 0.0)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        '''The histogram in Prometheus' text exposition format.'''
+        lines = ['# HELP {:s} {:s}'.format(self.name, self.doc),\
+                '# TYPE {:s} histogram'.format(self.name)]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for label_values, series in items:
+            labels = ''.join('{:s}="{:s}",'.format(label, escape(value))\
+                    for label, value in zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(bounds, series):
+                total += count
+                lines.append('{:s}_bucket{{{:s}le="{:s}"}} {:d}'.format(\
+                        self.name, labels, bound, total))
+            labels = '{{{:s}}}'.format(labels[:-1]) if labels else ''
+            lines.append('{:s}_sum{:s} {!r}'.format(self.name, labels,\
+                    series[-1]))
+            lines.append('{:s}_count{:s} {:d}'.format(self.name, labels,\
+                    total))
+        return '\n'.join(lines)
+
+
+def escape(value):
+    '''Escape a label value for the exposition format.'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').\
+            replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('pyro_request_duration_seconds',\
+        'Time taken to answer a request.', ('route', 'method', 'status'))
+REQUEST_MONGO_COMMANDS = Histogram('pyro_request_mongo_commands',\
+        'Mongo commands run to answer a request.', ('route',), COUNT_BUCKETS)
+REQUEST_MONGO_SECONDS = Histogram('pyro_request_mongo_duration_seconds',\
+        'Time a request spent waiting on Mongo.', ('route',))
+SERIALIZE_SECONDS = Histogram('pyro_serialize_duration_seconds',\
+        'Time a request spent encoding its response.', ('route',))
+MONGO_COMMAND_SECONDS = Histogram('pyro_mongo_command_duration_seconds',\
+        'Time Mongo took to answer a command.', ('command',))
+HISTOGRAMS = [REQUEST_SECONDS, REQUEST_MONGO_COMMANDS, REQUEST_MONGO_SECONDS,\
+        SERIALIZE_SECONDS, MONGO_COMMAND_SECONDS]
+
+
+def render():
+    '''Every metric, ready to serve at /_metrics.'''
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
+
+
+# The stats of the request being handled in this thread (or task), if any.
+_current = contextvars.ContextVar('pyro_request_stats', default=None)
+
+
+class RequestStats(object):
+    '''What one request spent its time on.'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.commands = [] # (command name, collection, seconds)
+        self.serialize_seconds = 0.0
+        self.pending = {} # request_id -> collection, for commands under way
+
+    @property
+    def mongo_seconds(self):
+        return sum(seconds for _, _, seconds in self.commands)
+
+    def breakdown(self, elapsed):
+        '''Mongo commands by name and collection, slowest first, then
+           serialization and everything else (hooks, Python).'''
+        totals = {}
+        for name, collection, seconds in self.commands:
+            count, total = totals.get((name, collection), (0, 0.0))
+            totals[(name, collection)] = (count + 1, total + seconds)
+        commands = ', '.join('{:s} {:s} x{:d} {:.3f}s'.format(name,\
+                collection or '-', count, total) for (name, collection),\
+                (count, total) in sorted(totals.items(),\
+                key=lambda item: -item[1][1]))
+        mongo = self.mongo_seconds
+        return 'mongo {:.3f}s in {:d} commands ({:s}), serialize {:.3f}s, '\
+                'other {:.3f}s'.format(mongo, len(self.commands), commands,\
+                self.serialize_seconds, elapsed - mongo -\
+                self.serialize_seconds)
+
+
+def start_request():
+    '''Start collecting stats for the request handled in this context.'''
+    stats = RequestStats()
+    _current.set(stats)
+    return stats
+
+
+def finish_request(route, method, status, description, slow_request=None):
+    '''Record the current request's stats under its route, and log them if
+       the request took slow_request seconds or more.'''
+    stats = _current.get()
+    if stats is None:
+        return
+    _current.set(None)
+    elapsed = time.perf_counter() - stats.start
+    REQUEST_SECONDS.observe(elapsed, route, method, str(status))
+    REQUEST_MONGO_COMMANDS.observe(len(stats.commands), route)
+    REQUEST_MONGO_SECONDS.observe(stats.mongo_seconds, route)
+    SERIALIZE_SECONDS.observe(stats.serialize_seconds, route)
+    if slow_request is not None and elapsed >= slow_request:
+        logger.warning('Slow request: %s %s took %.3fs: %s', method,\
+                description, elapsed, stats.breakdown(elapsed))
+
+
+def discard_request():
+    '''Drop the current request's stats unrecorded; whoever the request is
+       handed to records it instead.'''
+    _current.set(None)
+
+
+def record_serialization(seconds):
+    '''Count time spent encoding against the current request.'''
+    stats = _current.get()
+    if stats is not None:
+        stats.serialize_seconds += seconds
+
+
+class CommandTimer(monitoring.CommandListener):
+    '''Times each Mongo command, overall and for the request that ran it.
+       pymongo calls it on the thread (or task) that issued the command.'''
+
+    def started(self, event):
+        stats = _current.get()
+        if stats is not None:
+            collection = event.command.get(event.command_name)
+            stats.pending[event.request_id] =\
+                    collection if isinstance(collection, str) else None
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.observe(seconds, event.command_name)
+        stats = _current.get()
+        if stats is not None:
+            collection = stats.pending.pop(event.request_id, None)
+            stats.commands.append((event.command_name, collection, seconds))
+
+
+command_timer = CommandTimer()
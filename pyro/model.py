@@ -1,4 +1,3 @@
-from ipdb import set_trace as debug
 from flask import jsonify, request
 from pyro.database import *
 from pyro.utils import *
@@ -44,7 +43,7 @@ class Model(object):
 
     @classmethod
     def count(cls):
-        return cls._db[cls._collection_name()].count()
+        return cls._db[cls._collection_name()].count_documents({})
 
     @classmethod
     def delete_all(cls):
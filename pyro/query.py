@@ -0,0 +1,203 @@
+'''Compile index query strings into Mongo filters and sorts.'''
+import operator
+import re
+from bson import ObjectId
+from pyro.utils import *
+
+
+# Operators understood as field__op=value in a query string.
+OPERATORS = {'gt': '$gt', 'gte': '$gte', 'lt': '$lt', 'lte': '$lte',
+             'ne': '$ne', 'in': '$in', 'nin': '$nin'}
+LIST_OPERATORS = ('in', 'nin')
+INTEGER = re.compile(r'^-?\d+$')
+FLOAT = re.compile(r'^-?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?$')
+LITERALS = {'true': True, 'false': False, 'null': None}
+# Statistics an aggregate query can ask for, each over a list of fields.
+ACCUMULATORS = ('sum', 'avg', 'min', 'max')
+AGGREGATE_PARAMS = INDEX_PARAMS + ('groupBy',) + ACCUMULATORS
+
+
+def coerce_value(key, value):
+    '''Turn a query string value into the type Mongo should compare with.
+
+    Values under _id keys become ObjectIds (as deserialize does), and those
+    under createdAt and updatedAt datetimes (from ISO 8601, in UTC unless an
+    offset is given); true, false and null, integers and floats become the
+    corresponding Python values. Wrap a value in double quotes to keep it a
+    string, e.g. "42".
+    '''
+    if is_id_key(key):
+        if not ObjectId.is_valid(value):
+            raise ValueError('{:s} is not a valid _id'.format(value))
+        return ObjectId(value)
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    if key.rpartition('.')[2] in TIMESTAMP_FIELDS:
+        return parse_time(value)
+    if value in LITERALS:
+        return LITERALS[value]
+    if INTEGER.match(value):
+        return int(value)
+    if FLOAT.match(value):
+        return float(value)
+    return value
+
+
+def _arg_lists(args):
+    '''Yield (key, [values]) from a MultiDict or a plain dict.'''
+    if hasattr(args, 'lists'):
+        return args.lists()
+    return ((k, v if isinstance(v, list) else [v]) for k, v in args.items())
+
+
+def parse_filter(args, reserved=INDEX_PARAMS):
+    '''Compile every non-reserved query string argument into a Mongo filter.
+
+    title=Ulysses          -> {'title': 'Ulysses'}
+    pageCount__gt=100      -> {'page_count': {'$gt': 100}}
+    tags__in=sea,whales    -> {'tags': {'$in': ['sea', 'whales']}}
+    Repeating a plain key (tag=a&tag=b) matches any of the values.
+    '''
+    conditions = {}
+    for arg, values in _arg_lists(args):
+        if arg in reserved:
+            continue
+        field, _, op = arg.partition('__')
+        key = stored_field(field)
+        if op and op not in OPERATORS:
+            raise ValueError('{:s} is not a supported operator'.format(op))
+        condition = conditions.setdefault(key, {})
+        if op in LIST_OPERATORS:
+            items = [item for value in values for item in value.split(',')]
+            condition[OPERATORS[op]] = [coerce_value(key, v) for v in items]
+        elif op:
+            condition[OPERATORS[op]] = coerce_value(key, values[-1])
+        elif len(values) > 1:
+            condition['$in'] = [coerce_value(key, v) for v in values]
+        else:
+            condition['$eq'] = coerce_value(key, values[0])
+    query = {}
+    for key, condition in conditions.items():
+        if list(condition) == ['$eq']:
+            query[key] = condition['$eq']
+        else:
+            query[key] = condition
+    return query
+
+
+# How matches compares a value with an operand, for each operator.
+COMPARISONS = {'$eq': operator.eq, '$gt': operator.gt, '$gte': operator.ge,
+               '$lt': operator.lt, '$lte': operator.le}
+
+
+def _field_value(doc, key):
+    '''The value under a stored (possibly dotted) key, or None.'''
+    for segment in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(segment)
+    return doc
+
+
+def _satisfies(value, op, operand):
+    '''Does value pass one condition, as Mongo would judge it? Arrays pass
+       if they, or any of their items, do.'''
+    if op == '$ne':
+        return not _satisfies(value, '$eq', operand)
+    if op == '$nin':
+        return not _satisfies(value, '$in', operand)
+    if op == '$in':
+        return any(_satisfies(value, '$eq', item) for item in operand)
+    if op not in COMPARISONS:
+        raise ValueError('{:s} cannot be matched here'.format(op))
+    candidates = [value] + (value if isinstance(value, list) else [])
+    for candidate in candidates:
+        try:
+            if COMPARISONS[op](candidate, operand):
+                return True
+        except TypeError: # Mongo does not compare across types either
+            pass
+    return False
+
+
+def matches(doc, query):
+    '''Does doc match a filter compiled by parse_filter? Checked in Python,
+       for documents that are not (or no longer) in the database. Raises
+       ValueError for operators parse_filter does not produce.'''
+    for key, condition in query.items():
+        if key.startswith('$'):
+            raise ValueError('{:s} cannot be matched here'.format(key))
+        if not (isinstance(condition, dict) and condition and\
+                all(op.startswith('$') for op in condition)):
+            condition = {'$eq': condition}
+        value = _field_value(doc, key)
+        for op, operand in condition.items():
+            if not _satisfies(value, op, operand):
+                return False
+    return True
+
+
+def parse_sort(value):
+    '''Compile sort=-createdAt,title into [('createdAt', -1), ('title', 1)].'''
+    sort = []
+    for field in (value or '').split(','):
+        field = field.strip()
+        if not field:
+            continue
+        direction = -1 if field.startswith('-') else 1
+        sort.append((stored_field(field.lstrip('-+')), direction))
+    return sort
+
+
+def parse_query(args):
+    '''Compile an index query string into a Mongo (filter, sort) pair.'''
+    return parse_filter(args), parse_sort(args.get('sort'))
+
+
+def _field_list(value):
+    '''Stored keys for a comma separated list of fields.'''
+    return [stored_field(field.strip()) for field in (value or '').split(',')\
+            if field.strip()]
+
+
+def parse_aggregate(args):
+    '''Compile an aggregate query string into (filter, group_by, stats).
+
+    groupBy=genre&sum=pageCount&avg=rating,pageCount&rating__gt=3
+    -> ({'rating': {'$gt': 3}}, ['genre'],
+        {'sum': ['page_count'], 'avg': ['rating', 'page_count']})
+    '''
+    stats = dict((name, _field_list(args.get(name))) for name in ACCUMULATORS\
+            if args.get(name))
+    return parse_filter(args, AGGREGATE_PARAMS),\
+            _field_list(args.get('groupBy')), stats
+
+
+def aggregate_pipeline(query, group_by, stats):
+    '''Build the pipeline that counts the documents matching query, and
+       computes stats ({'avg': ['rating'], ...}) over them, per distinct
+       combination of the group_by fields.'''
+    unknown = set(stats) - set(ACCUMULATORS)
+    if unknown:
+        raise ValueError('{:s} is not a supported statistic'.format(\
+                sorted(unknown)[0]))
+    # Output names may not contain dots, so every field gets a numbered one.
+    group = {'_id': dict(('key{:d}'.format(k), '$' + field)\
+            for k, field in enumerate(group_by)) or None,\
+            'count': {'$sum': 1}}
+    for name, fields in stats.items():
+        for k, field in enumerate(fields):
+            group['{:s}{:d}'.format(name, k)] = {'$' + name: '$' + field}
+    return [{'$match': query}, {'$group': group}, {'$sort': {'_id': 1}}]
+
+
+def aggregate_result(doc, group_by, stats):
+    '''Name the numbered outputs of aggregate_pipeline after their fields:
+       {'genre': 'sea', 'count': 3, 'avg': {'rating': 4.8}}.'''
+    result = dict((field, doc['_id'].get('key{:d}'.format(k)))\
+            for k, field in enumerate(group_by))
+    result['count'] = doc['count']
+    for name, fields in stats.items():
+        result[name] = dict((field, doc['{:s}{:d}'.format(name, k)])\
+                for k, field in enumerate(fields))
+    return result
@@ -1,16 +1,26 @@
+import hashlib
+import json
 import re
-import sys
-import time
-from bson import ObjectId
-import inflect
-from ipdb import set_trace as debug
-import logging
-import numpy as np
-from pymongo import MongoClient
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from functools import lru_cache
+from itertools import islice
+from uuid import UUID
+import bson
+from bson import ObjectId, Decimal128
+from bson.errors import InvalidDocument
+try:
+    import orjson # much faster JSON encoding, if installed
+except ImportError:
+    orjson = None
 
 
-# Make an inflection engine.
-eng = inflect.engine()
+# Query string parameters reserved for pagination/sideloading of index routes.
+INDEX_PARAMS = ('limit', 'after', 'stream', 'include', 'fields', 'sort',\
+        'since')
+
+# Keys Pyro itself stores verbatim (camelCase) rather than snake_cased.
+TIMESTAMP_FIELDS = ('createdAt', 'updatedAt')
 
 
 def add_parent_id(parent_class, doc, parent_instance):
@@ -20,27 +30,60 @@ def add_parent_id(parent_class, doc, parent_instance):
     return doc
 
 
+@lru_cache(maxsize=None)
+def inflection_engine():
+    '''The inflect engine, imported on first use: importing inflect takes
+       seconds, so processes that never inflect a word never pay for it.'''
+    import inflect
+    return inflect.engine()
+
+
+@lru_cache(maxsize=None)
 def plural(noun):
     '''Returns the plural of a noun.'''
-    plural = eng.plural_noun(noun)
+    plural = inflection_engine().plural_noun(noun)
     return plural if plural else noun
 
 
+@lru_cache(maxsize=None)
 def singular(noun):
     '''Returns the singular form of a noun.'''
-    singular = eng.singular_noun(noun)
+    singular = inflection_engine().singular_noun(noun)
     return singular if singular else noun
 
 
+# Precompiled patterns used to translate keys between naming conventions.
+CAMEL_WORD = re.compile('(.)([A-Z][a-z]+)')
+CAMEL_HUMP = re.compile('([a-z0-9])([A-Z])')
+SNAKE_HUMP = re.compile(r'(?!^)_([a-zA-Z])')
+ID_KEY = re.compile(r'(_id)')
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Upper bound on distinct keys remembered by each key translation cache.
+KEY_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
 def camel_to_snake(camel):
     '''Convert camelCase to snake_case.'''
-    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', camel)
-    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+    s1 = CAMEL_WORD.sub(r'\1_\2', camel)
+    return CAMEL_HUMP.sub(r'\1_\2', s1).lower()
 
 
+def _upper_hump(match):
+    return match.group(1).upper()
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
 def snake_to_camel(snake):
     '''Convert snake_case to camelCase.'''
-    return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), snake)
+    return SNAKE_HUMP.sub(_upper_hump, snake)
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def is_id_key(key):
+    '''Does this (snake_case) key hold an ObjectId, e.g. _id or _user_id?'''
+    return key is not None and ID_KEY.search(key) is not None
 
 
 def snake_to_class(string):
@@ -49,80 +92,470 @@ def snake_to_class(string):
     return cameled[0].upper() + cameled[1:]
 
 
+def _copy_prefix(container, count):
+    '''Copy the first count (unchanged) entries of a dict or list.'''
+    if type(container) is dict:
+        return dict(islice(container.items(), count))
+    return container[:count]
+
+
+def walk_document(obj, translate_key, convert_leaf, key=None,\
+        leaf_key_translated=True):
+    '''Iteratively rebuild obj, translating dict keys and converting leaves.
+
+    Containers are only copied once one of their keys or values changes, so
+    subtrees that need no conversion are handed back untouched. Leaves are
+    converted with the key they live under (list elements inherit the key of
+    their list); leaf_key_translated picks the translated or original key.
+    '''
+    if type(obj) is dict:
+        items, is_dict = iter(obj.items()), True
+    elif type(obj) is list:
+        items, is_dict = enumerate(obj), False
+    else:
+        return convert_leaf(obj, key)
+    src, out, count, src_key, stack = obj, None, 0, key, []
+    while True:
+        for k, v in items:
+            if is_dict:
+                nk = translate_key(k)
+                v_key = nk if leaf_key_translated else k
+            else:
+                nk, v_key = k, src_key
+            v_type = type(v)
+            if v_type is dict or v_type is list: # descend into container
+                stack.append((src, items, out, count, src_key, is_dict, k, nk))
+                src, out, count, src_key = v, None, 0, v_key
+                if v_type is dict:
+                    items, is_dict = iter(v.items()), True
+                else:
+                    items, is_dict = enumerate(v), False
+                break
+            nv = convert_leaf(v, v_key)
+            if out is None and (nv is not v or nk != k):
+                out = _copy_prefix(src, count)
+            if out is not None:
+                if is_dict:
+                    out[nk] = nv
+                else:
+                    out.append(nv)
+            count += 1
+        else: # container exhausted; hand the result back to its parent
+            child, result = src, src if out is None else out
+            if not stack:
+                return result
+            src, items, out, count, src_key, is_dict, k, nk = stack.pop()
+            if out is None and (result is not child or nk != k):
+                out = _copy_prefix(src, count)
+            if out is not None:
+                if is_dict:
+                    out[nk] = result
+                else:
+                    out.append(result)
+            count += 1
+
+
+def _deserialize_leaf(obj, key):
+    '''Convert string _id to ObjectId, etc.'''
+    if (type(obj) is str) and is_id_key(key):
+        # Convert into an ObjectId so we can search in Mongo!
+        return ObjectId(obj)
+    return obj
+
+
+def _serialize_leaf(obj, key):
+    '''Check to see if the bare object needs special processing.'''
+    if (type(obj) is ObjectId) and is_id_key(key):
+        # Convert the ObjectId to a string so we can push through JSON.
+        return str(obj)
+    return obj
+
+
 def deserialize(obj, key=None):
-    '''Return object if it is simple; otherwise recursively iterate through.'''
-    if (type(obj) is list): # loop through elements, if list.
-        nlist = []
-        for el in obj:
-            nlist.append(deserialize(el))
-        return nlist
-    elif (type(obj) is dict): # loop through key,value pairs, if dict.
-        ndict = {}
-        for k,v in obj.items():
-            nk = camel_to_snake(k)
-            ndict[nk] = deserialize(v, key=nk)
-        return ndict
-    else: # convert string _id to ObjectId, etc.
-        if (type(obj) is str) and (re.search(r'(_id)', key)):
-            # Convert into an ObjectId so we can search in Mongo!
-            return ObjectId(obj)
-        else:
-            return obj
+    '''Convert camelCase keys to snake_case and string _ids to ObjectIds.'''
+    return walk_document(obj, camel_to_snake, _deserialize_leaf, key=key)
 
 
 def serialize(obj, key=None):
-    '''Return object if it is simple; otherwise recursively iterate through.'''
-    if (type(obj) is list): # loop through elements
-        nlist = []
-        for el in obj:
-            nlist.append(serialize(el))
-        return nlist
-    elif (type(obj) is dict): # loop through key,value pairs
-        ndict = {}
-        for k,v in obj.items():
-            ndict[snake_to_camel(k)] = serialize(v, key=k)
-        return ndict
-    else: # Check to see if the bare object needs special processing.
-        if (type(obj) is ObjectId) and (re.search(r'(_id)', key)):
-            # Convert the ObjectId to a string so we can push through JSON.
-            return str(obj)
-        else:
-            return obj
-        if isinstance(obj, np.generic):
-            return np.asscalar(obj)
+    '''Convert snake_case keys to camelCase and ObjectIds to strings.'''
+    return walk_document(obj, snake_to_camel, _serialize_leaf, key=key,\
+            leaf_key_translated=False)
+
+
+# Update operators an update request may send alongside plain fields.
+UPDATE_OPERATORS = ('$inc', '$push', '$addToSet', '$pull')
+
+
+def split_update(data):
+    '''Split an update request body into its plain fields and its update
+       operators ({'$inc': {'viewCount': 1}}, ...), deserializing both.'''
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object.')
+    fields, operators = {}, {}
+    for key, value in data.items():
+        if not key.startswith('$'):
+            fields[key] = value
+        elif key not in UPDATE_OPERATORS:
+            raise ValueError('Unsupported update operator {:s}.'.format(key))
+        elif not isinstance(value, dict):
+            raise ValueError('{:s} expects an object of fields.'.format(key))
+        else: # operator names are not camelCase keys; leave them be
+            operators[key] = deserialize(value)
+    return deserialize(fields), operators
+
+
+# Containers to_wire copies; anything else is a leaf for the JSON backend.
+JSON_CONTAINERS = (dict, list, tuple)
+
+
+def json_default(obj):
+    '''Encode the leaves JSON has no type for: ObjectIds as strings, dates
+       as ISO 8601 (naive times are UTC, as Mongo returns them), numpy
+       scalars and arrays as plain numbers and lists.'''
+    if type(obj) is ObjectId:
+        return str(obj)
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None or not obj.utcoffset():
+            return obj.replace(tzinfo=None).isoformat() + 'Z'
+        return obj.isoformat()
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if type(obj).__module__ == 'numpy': # no need to import numpy to check
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return to_wire(list(obj))
+    if isinstance(obj, (Decimal, Decimal128, UUID)):
+        return str(obj)
+    raise TypeError('{:s} is not JSON serializable'.format(\
+            type(obj).__name__))
+
+
+# Fallback encoder: compact, and no key sorting (unlike Flask's jsonify).
+_json_encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False,\
+        default=json_default)
+
+
+def to_wire(obj):
+    '''Copy the dicts and lists of obj, camelCasing keys as serialize()
+       does. Leaves are left for the JSON backend to convert as it writes.'''
+    if type(obj) is dict:
+        return {snake_to_camel(k): (to_wire(v) if type(v) in JSON_CONTAINERS\
+                else v) for k, v in obj.items()}
+    return [to_wire(v) if type(v) in JSON_CONTAINERS else v for v in obj]
+
+
+def encode(obj):
+    '''Serialize obj (documents, lists of them) straight to JSON bytes.'''
+    wire = to_wire(obj) if type(obj) in JSON_CONTAINERS else obj
+    if orjson is not None:
+        try:
+            # numpy values go through json_default too: OPT_SERIALIZE_NUMPY
+            # looks numpy up lazily, which is not thread safe in orjson 3.8.
+            return orjson.dumps(wire, default=json_default,\
+                    option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+        except TypeError: # e.g. integers beyond 64 bits; let json decide
+            pass
+    return _json_encoder.encode(wire).encode()
 
 
 class ForeignQuery(object):
     '''Returns an object that will make a defined query into the specified
-       collection.'''
+       collection. The query runs on the first call; later calls reuse the
+       result until the association is invalidated.'''
 
     def __init__(self, parent_instance, ChildClass):
-        self._db = parent_instance._db
         self.parent = parent_instance
         self.ChildClass = ChildClass
+        self._docs = None
 
-    def __call__(self, return_objects=False):
-        foreign_key = self.parent._foreign_key()
-        parent_id = self.parent._id
-        collection = self._db[self.ChildClass._plural_name]
-        children_docs = collection.find({foreign_key: parent_id})
+    def __call__(self, return_objects=False, fields=None):
+        if fields is not None: # projected results are not cached
+            children_docs = self._find(fields)
+        elif self._docs is None:
+            children_docs = self._docs = self._find()
+        else:
+            children_docs = self._docs
         if return_objects:
             return self.ChildClass.to_objects(children_docs)
         else:
-            return list(children_docs)
+            return children_docs
 
+    def _find(self, projection=None):
+        foreign_key = self.parent._foreign_key()
+        parent_id = self.parent._id
+        collection = self.ChildClass._collection()
+        return list(collection.find({foreign_key: parent_id}, projection))
 
-def assemble_params(Class, action, resource_id, request):
-    '''Create a convenient parameter dict for hook methods.'''
-    params = {}
+
+def _related(instance):
+    '''The instance's cache of loaded parents and children.'''
+    if instance._related is None:
+        instance._related = {}
+    return instance._related
+
+
+class LazyParent(object):
+    '''Descriptor that loads an instance's parent on first access, and caches
+       it beside (never in) the instance's document.'''
+
+    def __init__(self, ParentClass):
+        self.ParentClass = ParentClass
+        self.name = ParentClass._singular_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        related = _related(instance)
+        if self.name in related:
+            return related[self.name]
+        parent_id = instance._doc.get(self.ParentClass._foreign_key())
+        parent = None
+        if parent_id is not None:
+            parent = self.ParentClass.find_by_id(parent_id)
+        related[self.name] = parent
+        return parent
+
+
+class LazyChildren(object):
+    '''Descriptor that attaches a (cached) ForeignQuery for an instance's
+       children on first access.'''
+
+    def __init__(self, ChildClass):
+        self.ChildClass = ChildClass
+        self.name = ChildClass._plural_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        related = _related(instance)
+        if self.name not in related:
+            related[self.name] = ForeignQuery(instance, self.ChildClass)
+        return related[self.name]
+
+
+def index_params(args):
+    '''Extract (limit, after, stream, include) from an index query string.'''
+    limit = args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError('limit must be a positive integer')
+        limit = int(limit)
+    after = args.get('after')
+    if after is not None and not ObjectId.is_valid(after):
+        raise ValueError('after must be a valid _id')
+    stream = args.get('stream', 'false').lower() in ['true', '1', 'yes']
+    include = [camel_to_snake(name) for name in\
+            args.get('include', '').split(',') if name]
+    return limit, after, stream, include
+
+
+def stored_field(field):
+    '''Map a field named as in responses (camelCase, dotted for sub-documents)
+       to the key it is stored under, the inverse of serialize.'''
+    segments = field.split('.')
+    if not all(FIELD_NAME.match(segment) for segment in segments):
+        raise ValueError('{:s} is not a valid field'.format(field))
+    return '.'.join(segment if segment in TIMESTAMP_FIELDS else\
+            camel_to_snake(segment) for segment in segments)
+
+
+def fields_param(args):
+    '''Translate ?fields=title,createdAt into a Mongo projection. Returns
+       None when no fields were requested.'''
+    fields = [field.strip() for field in args.get('fields', '').split(',')]
+    fields = [field for field in fields if field]
+    if not fields:
+        return None
+    projection = dict((stored_field(field), 1) for field in fields)
+    for path in projection: # Mongo refuses overlapping paths
+        for other in projection:
+            if other.startswith(path + '.'):
+                error = 'fields {:s} and {:s} overlap'.format(path, other)
+                raise ValueError(error)
+    return projection
+
+
+def chunked(iterable, size):
+    '''Yield successive lists of up to size items from iterable.'''
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def stream_json(docs):
+    '''Yield a JSON array chunk by chunk, one serialized document at a time.'''
+    separator = b'['
+    for doc in docs:
+        yield separator + encode(doc)
+        separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+
+def utc_now():
+    '''The time to stamp documents with: naive UTC to the millisecond, just
+       as Mongo stores datetimes and pymongo reads them back.'''
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def parse_time(value):
+    '''Read an ISO 8601 date or time (2017-07-01, 2017-07-01T16:02:11Z) as a
+       naive UTC datetime. Times without an offset are taken to be UTC.'''
+    if isinstance(value, datetime):
+        stamp = value
+    else:
+        text = value[:-1] + '+00:00' if value.endswith('Z') else value
+        try:
+            stamp = datetime.fromisoformat(text)
+        except ValueError:
+            raise ValueError('{:s} is not an ISO 8601 time'.format(value))
+    if stamp.tzinfo is not None:
+        stamp = stamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return stamp
+
+
+def parse_watermark(value):
+    '''Read where a change feed left off: a time (a datetime, or ISO 8601), or
+       the watermark changes_since handed out. Returns the positions, as
+       (time, _id) pairs, of changed documents and of tombstones: what comes
+       after, _id breaking ties on the time (None: all of that time is to
+       come). An empty value starts from the beginning.'''
+    if not value:
+        return (None, None), (None, None)
+    if isinstance(value, datetime):
+        return (parse_time(value), None), (parse_time(value), None)
+    positions = []
+    for part in value.split(','):
+        stamp, _, _id = part.partition('/')
+        if _id and not ObjectId.is_valid(_id):
+            raise ValueError('{:s} is not a valid watermark'.format(value))
+        positions.append((parse_time(stamp), ObjectId(_id) if _id else None))
+    if len(positions) == 1:
+        return positions[0], positions[0]
+    if len(positions) != 2:
+        raise ValueError('{:s} is not a valid watermark'.format(value))
+    return positions[0], positions[1]
+
+
+def format_watermark(changed, deleted):
+    '''The watermark for the positions of changed documents and tombstones;
+       just the time, when both are at the start of the same millisecond.'''
+    def position(stamp, _id):
+        if _id is None:
+            return json_default(stamp)
+        return '{:s}/{:s}'.format(json_default(stamp), str(_id))
+    if changed == deleted and changed[1] is None:
+        return position(*changed)
+    return '{:s},{:s}'.format(position(*changed), position(*deleted))
+
+
+def feed_position(position):
+    '''Sort key for change feed positions: at the same time, a position with
+       no _id (all of that time) comes before any with one.'''
+    stamp, _id = position
+    return stamp, _id is not None, str(_id or '')
+
+
+def parse_timestamp(stamp):
+    '''Read a stored timestamp as an aware UTC datetime (None if unreadable).
+       Datetimes from Mongo are naive UTC; strings were written by older
+       versions of Pyro with str(datetime.now()), i.e. in local time.'''
+    if isinstance(stamp, str):
+        try:
+            return datetime.fromisoformat(stamp).astimezone(timezone.utc)
+        except ValueError:
+            return None
+    if not isinstance(stamp, datetime):
+        return None
+    if stamp.tzinfo is None:
+        return stamp.replace(tzinfo=timezone.utc)
+    return stamp.astimezone(timezone.utc)
+
+
+def fingerprint(value):
+    '''Digest of a value as Mongo would store it, to tell whether it changed
+       without holding on to a copy. None if Mongo could not store it.'''
+    try:
+        encoded = bson.encode({'': value})
+    except (InvalidDocument, TypeError, OverflowError):
+        return None
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+
+def validators(docs, related=(), salt=b''):
+    '''ETag and Last-Modified time for a document, or a list of them.
+
+    The ETag hashes each document's _id and updatedAt, plus those of the
+    documents sideloaded under the related keys, so it changes whenever a
+    document in the result is written, added or removed. Only a document
+    alone gets a Last-Modified time: the newest updatedAt of a list (or of a
+    document and what was sideloaded with it) stays put when an older member
+    is removed. Returns (None, None) if a document lacks either field, e.g.
+    when a sparse fieldset left updatedAt out.
+    '''
+    digest = hashlib.sha1(salt)
+    stamps = []
+    pending = [docs] if isinstance(docs, dict) else list(docs)
+    pending.reverse()
+    while pending:
+        doc = pending.pop()
+        if doc is None: # a sideloaded parent that no longer exists
+            digest.update(b'-;')
+            continue
+        if '_id' not in doc or 'updatedAt' not in doc:
+            return None, None
+        digest.update('{:s}@{:s};'.format(str(doc['_id']),\
+                str(doc['updatedAt'])).encode())
+        stamps.append(doc['updatedAt'])
+        for key in related:
+            value = doc.get(key)
+            pending.extend(value if isinstance(value, list) else [value])
+    last_modified = None
+    if isinstance(docs, dict) and len(stamps) == 1:
+        last_modified = parse_timestamp(stamps[0])
+    return digest.hexdigest(), last_modified
+
+
+def not_modified(request, etag, last_modified):
+    '''Does the request's If-None-Match (or, failing that, If-Modified-Since)
+       show that the client's copy is current?'''
+    if etag is None:
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return last_modified is not None\
+            and request.if_modified_since is not None\
+            and last_modified.replace(microsecond=0)\
+                <= request.if_modified_since
+
+
+def cache_headers(resp, etag, last_modified, cache_control=None):
+    '''Set validators and Cache-Control on a response.'''
+    if etag is not None:
+        resp.set_etag(etag, weak=True)
+    if last_modified is not None: # None would stamp the current time
+        resp.last_modified = last_modified
+    if cache_control is not None:
+        resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+def assemble_params(Class, action, resource_id, request, ancestor_ids=None):
+    '''Create a convenient parameter dict for hook methods. Routes nested more
+       than one level deep also name the ancestors above the parent, under
+       their foreign keys (ancestor_ids).'''
+    params = dict(ancestor_ids or {})
     if resource_id is not None:
-        if action in ['index', 'create'] and resource_id:
+        if action in ['index', 'create', 'upsert', 'count',\
+                'aggregate', 'events'] and resource_id:
             resource_name = Class._parent._foreign_key()
         else:
             resource_name = Class._foreign_key()
         params[resource_name] = resource_id
     params['action'] = action
-    params['request_data'] = request.json
+    params['request_data'] = request.get_json(silent=True)
     params['request'] = request
     params['status_code'] = 200 # default
     params['class'] = Class
@@ -140,6 +573,15 @@ def clean_document(doc):
     return doc
 
 
+def bulk_error(index, status_code, errors):
+    '''Describe why item index of a bulk request failed.'''
+    if isinstance(errors, dict) and 'errors' in errors:
+        errors = errors['errors']
+    if not isinstance(errors, list):
+        errors = [str(errors)]
+    return {'index': index, 'status': status_code, 'errors': errors}
+
+
 def create_model_params(cls=None, obj=None,  doc=None, parent=None):
     '''Create params dict for model hooks.'''
     params = {}
@@ -0,0 +1,172 @@
+'''Drive the ASGI application in-process, with mongomock as a local stand-in for
+Mongo, so no database, test server, or ASGI server needs to be running.'''
+import asyncio
+import json
+import time
+import mongomock
+from nose.tools import assert_equals
+from nose import with_setup
+from pyro.basics import *
+from pyro.asgi import AsyncApplication
+from pyro.events import bus_for
+
+N_REQUESTS = 200
+
+
+# SETUP -----------------------------------------------------
+def setup():
+    global app, saved_db, Shelf, Gadget
+    class Shelf(Pyro): pass
+    class Gadget(Pyro):
+        @staticmethod
+        def before_create(params): # blocking hooks run in the thread pool
+            time.sleep(0.1)
+        @staticmethod
+        async def after_show(params):
+            params['resp'].headers['X-Shown'] = 'yes'
+    Shelf.has_many(Gadget)
+    Gadget.tracks_changes()
+    saved_db = Pyro._db
+    Pyro.attach_db(mongomock.MongoClient().db)
+    app = AsyncApplication(Pyro)
+
+
+def teardown():
+    Pyro._registry.discard(Shelf)
+    Pyro._registry.discard(Gadget)
+    Pyro._db = saved_db
+
+
+async def call(method, path, data=None, headers=None, hangup=None):
+    '''Send one request through the app; return (status, headers, body).
+       The client stays connected until the response ends, or until the
+       hangup event (an asyncio.Event) is set.'''
+    hangup = hangup or asyncio.Event()
+    path, _, query_string = path.partition('?')
+    body = json.dumps(data).encode() if data is not None else b''
+    headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+    scope = {'type': 'http', 'method': method, 'path': path,\
+            'query_string': query_string.encode(),\
+            'headers': [(k.lower().encode(), v.encode())\
+                for k, v in headers.items()]}
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await hangup.wait()
+        return {'type': 'http.disconnect'}
+    async def send(message):
+        sent.append(message)
+    await app(scope, receive, send)
+    hangup.set()
+    resp_headers = dict((k.decode(), v.decode())\
+            for k, v in sent[0]['headers'])
+    resp_body = b''.join(message.get('body', b'') for message in sent[1:])
+    if resp_headers.get('content-type') == 'application/json':
+        resp_body = json.loads(resp_body)
+    return sent[0]['status'], resp_headers, resp_body
+
+
+def run(*calls):
+    '''Run calls concurrently on one event loop.'''
+    async def gather():
+        return await asyncio.gather(*calls)
+    return asyncio.run(gather())
+
+
+# BEGIN TESTS ------------------------------------------------------
+@with_setup(setup, teardown)
+def crud_test():
+    [(status, _, shelf)] = run(call('POST', '/shelves', {'roomName': 'den'}))
+    assert_equals((status, shelf['roomName']), (200, 'den'))
+    shelf_url = '/shelf/{:s}'.format(shelf['_id'])
+    [(status, _, shelf)] = run(call('PUT', shelf_url, {'roomName': 'attic'}))
+    assert_equals(shelf['roomName'], 'attic')
+    [(_, _, shelf)] = run(call('PUT', shelf_url, {'$inc': {'height': 2}}))
+    assert_equals((shelf['roomName'], shelf['height']), ('attic', 2))
+    [(_, headers, shown)] = run(call('GET', shelf_url))
+    assert_equals(shown, shelf)
+    [(status, _, _)] = run(call('GET', shelf_url,\
+            headers={'If-None-Match': headers['etag']}))
+    assert_equals(status, 304)
+    [(status, _, _)] = run(call('DELETE', shelf_url))
+    assert_equals(status, 200)
+    [(status, _, _), (_, _, shelves)] = run(call('GET', shelf_url),\
+            call('GET', '/shelves'))
+    assert_equals((status, shelves), (404, []))
+
+
+@with_setup(setup, teardown)
+def nested_and_fallback_test():
+    [(_, _, shelf)] = run(call('POST', '/shelves', {}))
+    nested_url = '/shelf/{:s}/gadgets'.format(shelf['_id'])
+    for k in range(3):
+        run(call('POST', nested_url, {'serial': k}))
+    [(_, headers, gadgets)] = run(call('GET', nested_url + '?limit=2'))
+    assert_equals([g['serial'] for g in gadgets], [0, 1])
+    assert 'x-next-cursor' in headers
+    [(_, headers, shown)] = run(call('GET', '/gadget/' + gadgets[0]['_id']))
+    assert_equals(headers['x-shown'], 'yes') # a coroutine hook
+    [(_, _, streamed)] = run(call('GET', '/gadgets?stream=true&include=shelf'))
+    assert_equals([g['shelf']['_id'] for g in streamed], [shelf['_id']] * 3)
+    [(_, _, shelves)] = run(call('GET', '/shelves?include=gadgets'))
+    assert_equals([len(s['gadgets']) for s in shelves], [3])
+    ids = [g['_id'] for g in streamed]
+    [(status, _, deleted)] = run(call('DELETE', '/gadgets/bulk', ids)) # Flask
+    assert_equals((status, deleted['deleted']), (200, ids))
+    [(_, _, delta)] = run(call('GET', nested_url + '?since=')) # Flask too
+    assert_equals((delta['changed'], delta['deleted']), ([], ids))
+
+
+@with_setup(setup, teardown)
+def fallback_metrics_test():
+    from pyro.metrics import REQUEST_SECONDS
+    before, _ = REQUEST_SECONDS.series('gadgets.index', 'GET', '200')
+    run(call('GET', '/gadgets?since=')) # handed to Flask
+    after, _ = REQUEST_SECONDS.series('gadgets.index', 'GET', '200')
+    assert_equals(after - before, 1) # recorded by Flask alone
+
+
+@with_setup(setup, teardown)
+def events_test():
+    Gadget.event_heartbeat = 0.05 # how soon a hang up is noticed
+    [(_, _, shelf), (_, _, other)] = run(call('POST', '/shelves', {}),\
+            call('POST', '/shelves', {}))
+    nested_url = '/shelf/{:s}/gadgets'.format(shelf['_id'])
+    async def listen_while_writing():
+        hangup = asyncio.Event()
+        listener = asyncio.ensure_future(call('GET',\
+                nested_url + '/events?serial__gte=1', hangup=hangup))
+        await asyncio.sleep(0.1) # subscribed by now
+        for k in range(3):
+            await call('POST', nested_url, {'serial': k})
+        await call('POST', '/shelf/{:s}/gadgets'.format(other['_id']),\
+                {'serial': 5}) # not on this shelf
+        hangup.set()
+        return await listener
+    [(status, headers, body)] = run(listen_while_writing())
+    assert_equals(status, 200)
+    assert headers['content-type'].startswith('text/event-stream')
+    events = [line for line in body.decode().split('\n')\
+            if line.startswith(('event:', 'data:'))]
+    assert_equals([line for line in events if line.startswith('event:')],\
+            ['event: create', 'event: create'])
+    assert_equals([json.loads(line[6:])['serial'] for line in events\
+            if line.startswith('data:')], [1, 2])
+    assert_equals(bus_for(Gadget).subscribers, set())
+
+
+@with_setup(setup, teardown)
+def concurrent_requests_test():
+    [(_, _, shelf)] = run(call('POST', '/shelves', {}))
+    nested_url = '/shelf/{:s}/gadgets'.format(shelf['_id'])
+    start = time.time()
+    results = run(*[call('POST', nested_url, {'serial': k})\
+            for k in range(N_REQUESTS)])
+    # Each create sleeps 0.1s in its hook; they must not queue on the loop.
+    assert time.time() - start < N_REQUESTS * 0.1 / 4
+    assert_equals([gadget['serial'] for _, _, gadget in results],\
+            list(range(N_REQUESTS)))
+    [(_, _, gadgets)] = run(call('GET', nested_url))
+    assert_equals(len(gadgets), N_REQUESTS)
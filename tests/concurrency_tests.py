@@ -0,0 +1,61 @@
+'''Fire parallel requests at a threaded application and make sure responses
+never leak between requests. Uses mongomock as a local stand-in for Mongo, so
+no database or test server needs to be running.'''
+from concurrent.futures import ThreadPoolExecutor
+import mongomock
+from nose.tools import assert_equals
+from nose import with_setup
+from pyro.basics import *
+
+N_REQUESTS = 400
+N_THREADS = 16
+
+
+# SETUP -----------------------------------------------------
+def setup():
+    global app, saved_db, Gadget
+    class Gadget(Pyro): pass
+    saved_db = Pyro._db
+    Pyro.attach_db(mongomock.MongoClient().db)
+    app = Application(Pyro).app
+
+
+def teardown():
+    Pyro._registry.discard(Gadget)
+    Pyro._db = saved_db
+
+
+def in_parallel(fn, args):
+    with ThreadPoolExecutor(max_workers=N_THREADS) as pool:
+        return list(pool.map(fn, args))
+
+
+def create_gadget(serial):
+    resp = app.test_client().post('/gadgets', json={'serial': serial})
+    return serial, resp.get_json()
+
+
+def show_gadget(gadget):
+    resp = app.test_client().get('/gadget/{:s}'.format(gadget['_id']))
+    return gadget, resp.get_json()
+
+
+# BEGIN TESTS ------------------------------------------------------
+@with_setup(setup, teardown)
+def parallel_create_test():
+    results = in_parallel(create_gadget, range(N_REQUESTS))
+    for serial, gadget in results:
+        assert_equals(gadget['serial'], serial)
+    assert_equals(len(set(g['_id'] for _, g in results)), N_REQUESTS)
+
+
+@with_setup(setup, teardown)
+def parallel_create_and_show_test():
+    gadgets = [g for _, g in in_parallel(create_gadget, range(N_REQUESTS))]
+    def create_or_show(k):
+        if k % 2:
+            return create_gadget(N_REQUESTS + k)
+        gadget, shown = show_gadget(gadgets[k])
+        return gadget['serial'], shown
+    for serial, gadget in in_parallel(create_or_show, range(N_REQUESTS)):
+        assert_equals(gadget['serial'], serial)
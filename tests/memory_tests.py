@@ -0,0 +1,54 @@
+'''Keep model instances compact. Index routes and to_objects materialize
+whole result sets, so every byte an instance adds to its document is paid per
+document listed.'''
+import tracemalloc
+from datetime import datetime
+from bson import ObjectId
+from nose.tools import assert_equals
+from pyro.basics import *
+
+INSTANCES = 100000
+# Bytes an instance may add to the document it wraps: the object and its
+# record of the stored document (needed to save only what changed), which
+# must not grow with the document's arrays.
+INSTANCE_BUDGET = 512
+
+
+def stored_docs(n):
+    '''Documents as Mongo hands them over.'''
+    now = datetime(2017, 7, 21, 10, 31)
+    return [{'_id': ObjectId(), 'title': 'Volume {:d}'.format(k),\
+            'page_count': k, 'tags': ['sea', 'whales'],\
+            'word_counts': [(k + page) % 100 for page in range(200)],\
+            'author': {'name': 'Herman Melville', 'born': 1819},\
+            'createdAt': now, 'updatedAt': now} for k in range(n)]
+
+
+def allocated(build):
+    '''Run build(); return what it returns and the bytes it allocated that
+       are still held.'''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+# BEGIN TESTS ------------------------------------------------------
+def instance_memory_test():
+    class Volume(Pyro): pass
+    docs = stored_docs(INSTANCES)
+    volumes, size = allocated(lambda: [Volume._from_db(doc) for doc in docs])
+    per_instance = size / INSTANCES
+    assert per_instance < INSTANCE_BUDGET, per_instance
+    # The document is the instance's state, not copied into it.
+    assert volumes[7]._doc is docs[7]
+    volumes[7].word_counts.append(0) # changed in place, and noticed
+    assert_equals(list(volumes[7]._changes()[0]), ['word_counts'])
+    volumes[7].title = 'Moby Dick'
+    del volumes[7].tags
+    assert_equals(docs[7]['title'], 'Moby Dick')
+    assert 'tags' not in docs[7]
+    assert not hasattr(volumes[7], 'tags')
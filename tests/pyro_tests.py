@@ -1,5 +1,7 @@
 from nose.tools import assert_equals, assert_almost_equals, assert_raises
 from nose import with_setup
+from datetime import datetime
+import json
 import numpy as np
 from numpy.testing import assert_array_almost_equal_nulp, assert_array_equal
 import requests
@@ -42,7 +44,9 @@ def registry_test():
 @with_setup(setup, teardown)
 def empty_doc_test():
     class Widget(Pyro): pass
-    assert Widget._doc is None
+    widget = Widget({})
+    assert_equals(widget._doc, {})
+    assert widget._doc is widget.__dict__
 
 
 @with_setup(setup, teardown)
@@ -92,6 +96,446 @@ def has_many_test():
     Book.delete_all()
 
 
+def serialize_round_trip_test():
+    _id, author_id = ObjectId(), ObjectId()
+    doc = {'_id': _id, '_author_id': author_id, 'page_count': 12,\
+            'chapters': [{'chapter_title': 'Call Me Ishmael'}],\
+            'stats': {'rating': 4.8}}
+    wire = serialize(doc)
+    assert_equals(wire['_id'], str(_id))
+    assert_equals(wire['_authorId'], str(author_id))
+    assert_equals(wire['chapters'][0]['chapterTitle'], 'Call Me Ishmael')
+    assert wire['stats'] is doc['stats'] # untouched subtrees are not copied
+    assert_equals(deserialize(wire), doc)
+
+
+@with_setup(setup, teardown)
+def find_page_test():
+    class Widget(Pyro): pass
+    Widget.delete_all()
+    for rank in range(5):
+        Widget.create({'rank': rank})
+    page, cursor = Widget.find_page(limit=2)
+    assert_equals([w['rank'] for w in page], [0, 1])
+    page, cursor = Widget.find_page(limit=2, after=cursor)
+    assert_equals([w['rank'] for w in page], [2, 3])
+    page, cursor = Widget.find_page(limit=2, after=cursor)
+    assert_equals([w['rank'] for w in page], [4])
+    assert cursor is None
+    Widget.delete_all()
+
+
+@with_setup(setup, teardown)
+def with_related_test():
+    class Author(Pyro): pass
+    class Book(Pyro): pass
+    Author.delete_all()
+    Book.delete_all()
+    Author.has_many(Book)
+    mjl = Author.create({'firstName': 'Matthew J. Lewis'})
+    ernie = Author.create({'firstName': 'Ernest Hemingway'})
+    Book.create({'title': 'Macbeth'}, mjl)
+    Book.create({'title': 'Hamlet'}, mjl)
+    Book.create({'title': 'The Sun Also Rises'}, ernie)
+    books = Book.all(include=['author'])
+    assert_equals(books[2]['author']['first_name'], 'Ernest Hemingway')
+    authors = Author.find_where({}, include=['books'])
+    assert_equals([len(a['books']) for a in authors], [2, 1])
+    assert_raises(ValueError, Author.all, ['publisher'])
+    Author.delete_all()
+    Book.delete_all()
+
+
+@with_setup(setup, teardown)
+def lazy_association_test():
+    class Author(Pyro): pass
+    class Book(Pyro): pass
+    Author.delete_all()
+    Book.delete_all()
+    Author.has_many(Book)
+    mjl = Author.create({'firstName': 'Matthew J. Lewis'})
+    macbeth = Book.create({'title': 'Macbeth'}, mjl)
+    book = Book.find_by_id(macbeth._id)
+    assert not book._related # nothing loaded yet
+    assert_equals(book.author.first_name, 'Matthew J. Lewis')
+    assert 'author' in book._related # ...and now it is cached,
+    assert 'author' not in book._doc # beside the document
+    book.invalidate_associations()
+    assert 'author' not in book._related
+    assert_equals(len(mjl.books()), 1)
+    Book.create({'title': 'Hamlet'}, mjl) # invalidates mjl.books
+    assert_equals(len(mjl.books()), 2)
+    Author.delete_all()
+    Book.delete_all()
+
+
+@with_setup(setup, teardown)
+def deep_nesting_test():
+    class Org(Pyro): pass
+    class Project(Pyro): pass
+    class Task(Pyro): pass
+    Org.has_many(Project)
+    Project.has_many(Task)
+    routes = Org._routes()
+    assert_equals(routes['org.projects.tasks.index']['route'],\
+            '/org/<_org_id>/projects/<resource_id>/tasks')
+    assert routes['org.projects.tasks.index']['callback'] == Task._index
+    for Model in [Org, Project, Task]:
+        Model.delete_all()
+    acme, other = Org.create({'name': 'Acme'}), Org.create({'name': 'Other'})
+    site = Project.create({'name': 'Site'}, acme)
+    launch = Task.create({'name': 'Launch', 'points': 3}, site)
+    Task.create({'name': 'Fix', 'points': 1}, site)
+    query = {'_project_id': site._id}
+    owned = [(Project, site._id), (Org, acme._id)]
+    foreign = [(Project, site._id), (Org, other._id)]
+    # The chain is checked once, on the parent; the listing is a plain find.
+    assert_equals(Task._owned({}, owned), query)
+    assert_equals(Task._owned({}, foreign), None)
+    tasks = Task.find_where(query, fields=['name'], ancestry=owned)
+    assert_equals(sorted(t['name'] for t in tasks), ['Fix', 'Launch'])
+    assert '_ancestor0' not in tasks[0]
+    assert_equals(Task.find_where(query, ancestry=foreign), [])
+    docs, _ = Task.find_page(query, limit=1, sort=[('points', -1)],\
+            ancestry=owned)
+    assert_equals([d['name'] for d in docs], ['Launch'])
+    assert_equals(list(Task.iter_where(query, ancestry=foreign)), [])
+    assert_equals(Task.count(query, owned), 2)
+    assert_equals(Task.count(query, foreign), 0)
+    assert_equals(Task.aggregate(query, ancestry=owned, sum=['points']),\
+            [{'count': 2, 'sum': {'points': 4}}])
+    assert_equals(Task.aggregate(query, ancestry=foreign, sum=['points']), [])
+    assert Project.find_by_id(site._id, ancestry=[(Org, acme._id)])
+    assert not Project.find_by_id(site._id, ancestry=[(Org, other._id)])
+    assert Task.find_by_id(launch._id, ancestry=owned)
+    assert not Task.find_by_id(launch._id, ancestry=foreign)
+    assert_equals(Task._ancestry(str(site._id), {'_org_id': str(acme._id)}),\
+            owned)
+    for Model in [Org, Project, Task]:
+        Model.delete_all()
+
+
+@with_setup(setup, teardown)
+def bulk_model_test():
+    class Widget(Pyro):
+        def before_save_model(self):
+            self.inspected = True
+    Widget.delete_all()
+    widgets, errors = Widget.create_many([{'name': 'a'}, {'name': 'b'}])
+    assert_equals(errors, [])
+    assert all(w.inspected for w in widgets)
+    updates = [{'_id': str(widgets[0]._id), 'name': 'c', 'partCount': 2},\
+            {'_id': 'bogus'}]
+    updated, errors = Widget.update_many(updates)
+    assert_equals((updated[0].name, updated[0].part_count), ('c', 2))
+    assert_equals([(e['index'], e['status']) for e in errors], [(1, 400)])
+    stored = Widget.find_by_id(widgets[0]._id)
+    assert_equals((stored.name, stored.part_count), ('c', 2))
+    Widget._collection().delete_one({'_id': widgets[1]._id})
+    real_load_many = Widget._load_many
+    Widget._load_many = classmethod(lambda cls, ids: ([widgets[1]], []))
+    try: # deleted between the load and the write
+        updated, errors = Widget.update_many([{'_id': widgets[1]._id}])
+    finally:
+        Widget._load_many = real_load_many
+    assert_equals(updated, [])
+    assert_equals([(e['index'], e['status']) for e in errors], [(0, 404)])
+    deleted, errors = Widget.delete_many([w._id for w in widgets])
+    assert_equals(len(deleted), 1)
+    assert_equals(Widget.all(), [])
+
+
+@with_setup(setup, teardown)
+def partial_save_test():
+    class Widget(Pyro): pass
+    widget = Widget.create({'name': 'a', 'parts': [1], 'color': 'red'})
+    widget = Widget.find_by_id(widget._id)
+    widget.parts.append(2)
+    del widget.color
+    _, update = widget._prepare_update()
+    assert_equals(sorted(update['$set']), ['parts', 'updatedAt'])
+    assert_equals(update['$unset'], {'color': ''})
+    widget.save()
+    widget = Widget.find_by_id(widget._id)
+    assert_equals((widget.parts, hasattr(widget, 'color')), ([1, 2], False))
+    assert widget.modify({'$inc': {'count': 2}, '$push': {'parts': 3}})
+    assert_equals((widget.count, widget.parts), (2, [1, 2, 3]))
+    widget.count = 0
+    assert_raises(ValueError, widget.modify, {'$inc': {'count': 1}})
+    Widget.delete_all()
+
+
+@with_setup(setup, teardown)
+def upsert_model_test():
+    class Widget(Pyro): pass
+    Widget.upserts_on('serialNumber')
+    Widget.delete_all()
+    Widget.ensure_indexes()
+    first = Widget.upsert({'serialNumber': 'W-1', 'color': 'red'})
+    second = Widget.upsert({'serialNumber': 'W-1', 'size': 3})
+    assert_equals(second._id, first._id)
+    assert_equals((second.color, second.size), ('red', 3))
+    assert_equals(second.createdAt, first.createdAt)
+    assert_raises(ValueError, Widget.upsert, {'color': 'blue'})
+    assert_equals(len(Widget.all()), 1)
+    Widget._collection().drop()
+
+
+@with_setup(setup, teardown)
+def change_feed_test():
+    class Widget(Pyro): pass
+    Widget.tracks_changes()
+    Widget.sync_lag = 0
+    Widget.delete_all()
+    Widget._tombstones().drop()
+    assert_raises(ValueError, Author.changes_since, '')
+    (doomed, kept), _ = Widget.create_many([{'color': 'red'},\
+            {'color': 'blue'}])
+    feed = Widget.changes_since('')
+    assert_equals((len(feed['changed']), feed['deleted']), (2, []))
+    page = Widget.changes_since('', limit=1)
+    assert_equals((len(page['changed']), page['more']), (1, True))
+    doomed.delete()
+    kept.color = 'green'
+    kept.save()
+    delta = Widget.changes_since(feed['watermark'])
+    assert_equals(delta['deleted'], [doomed._id])
+    assert_equals([doc['color'] for doc in delta['changed']], ['green'])
+    # More documents than the limit share one timestamp: paging goes on by _id
+    Widget.delete_all()
+    Widget._tombstones().drop()
+    widgets, _ = Widget.create_many([{'n': k} for k in range(7)])
+    Widget._collection().update_many({},\
+            {'$set': {'updatedAt': kept.updatedAt}})
+    Widget.delete_many([w._id for w in widgets[:5]]) # one stamp for all five
+    Widget._tombstones().update_many({},\
+            {'$set': {'deletedAt': kept.updatedAt}}) # and settled
+    changed, deleted, watermark = [], [], ''
+    for _ in range(10):
+        page = Widget.changes_since(watermark, limit=2)
+        changed += [doc['_id'] for doc in page['changed']]
+        deleted += page['deleted']
+        watermark = page['watermark']
+        if not page['more']:
+            break
+    assert not page['more']
+    assert_equals(sorted(changed), sorted(w._id for w in widgets[5:]))
+    assert_equals(sorted(deleted), sorted(w._id for w in widgets[:5]))
+    # Stamps not yet migrated to dates are left out, rather than compared.
+    Widget._collection().insert_one({'n': 7,\
+            'updatedAt': '2017-07-21 10:31:00.500131'})
+    page = Widget.changes_since('', limit=1)
+    assert_equals([doc['n'] for doc in page['changed']], [5])
+    Widget._collection().drop()
+    Widget._tombstones().drop()
+
+
+@with_setup(setup, teardown)
+def timestamp_test():
+    class Widget(Pyro): pass
+    Widget.delete_all()
+    widget = Widget.create({'color': 'red'})
+    assert isinstance(widget.createdAt, datetime)
+    stored = Widget.find_by_id(widget._id)
+    assert_equals(stored.createdAt, widget.createdAt) # UTC, to the ms
+    Widget._collection().insert_one({'color': 'blue',\
+            'createdAt': '2017-07-21 10:31:00.500131',\
+            'updatedAt': '2017-07-21 10:31:00.500131'})
+    assert_equals(Widget.migrate_timestamps(), {'widgets': 1})
+    assert_equals(Widget.migrate_timestamps(), {'widgets': 0})
+    old = Widget._collection().find_one({'color': 'blue'})
+    assert isinstance(old['updatedAt'], datetime)
+    Widget.delete_all()
+
+
+@with_setup(setup, teardown)
+def count_and_aggregate_test():
+    class Widget(Pyro): pass
+    Widget.delete_all()
+    Widget.create_many([{'color': 'red', 'size': 1}, {'color': 'red',\
+            'size': 3}, {'color': 'blue', 'size': 5}])
+    assert_equals(Widget.count(), 3)
+    assert_equals(Widget.count({'color': 'red'}), 2)
+    groups = Widget.aggregate(group_by=['color'], avg=['size'], max=['size'])
+    assert_equals(groups, [
+        {'color': 'blue', 'count': 1, 'avg': {'size': 5}, 'max': {'size': 5}},
+        {'color': 'red', 'count': 2, 'avg': {'size': 2}, 'max': {'size': 3}}])
+    assert_raises(ValueError, Widget.aggregate, median=['size'])
+    Widget.delete_all()
+
+
+@with_setup(setup, teardown)
+def event_bus_test():
+    from pyro.events import ThreadSubscriber, bus_for, event_filter
+    class Widget(Pyro): pass
+    Widget.delete_all()
+    subscriber = ThreadSubscriber(event_filter({'color': 'red'}), 10)
+    bus_for(Widget).subscribe(subscriber)
+    widget = Widget.create({'color': 'red'})
+    Widget.create({'color': 'blue'})
+    widget.size = 3
+    widget.save()
+    widget.delete()
+    events = [subscriber.get(5) for _ in range(3)]
+    assert_equals([event.kind for event in events],\
+            ['create', 'update', 'delete'])
+    assert_equals(json.loads(events[1].data)['size'], 3)
+    bus_for(Widget).unsubscribe(subscriber)
+    Widget.delete_all()
+
+
+def matches_test():
+    doc = {'title': 'Moby Dick', 'tags': ['sea', 'whales'], 'page_count': 635}
+    assert matches(doc, parse_filter({'tags': 'sea', 'pageCount__gt': '600'}))
+    assert not matches(doc, parse_filter({'tags__nin': 'whales'}))
+    assert matches(doc, parse_filter({'rating__ne': '5'}))
+    assert_raises(ValueError, matches, doc, {'$or': []})
+
+
+def histogram_test():
+    from pyro.metrics import Histogram
+    histogram = Histogram('t_seconds', 'Test.', ('route',), (0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value, 'a"b')
+    assert_equals(histogram.render().splitlines()[2:], [
+        't_seconds_bucket{route="a\\"b",le="0.1"} 2',
+        't_seconds_bucket{route="a\\"b",le="1.0"} 3',
+        't_seconds_bucket{route="a\\"b",le="+Inf"} 4',
+        't_seconds_sum{route="a\\"b"} 3.65',
+        't_seconds_count{route="a\\"b"} 4'])
+
+
+@with_setup(setup, teardown)
+def request_metrics_test():
+    from pyro.metrics import REQUEST_MONGO_COMMANDS
+    class Widget(Pyro): pass
+    widget = Widget.create({'name': 'a'})
+    client = Application(Pyro, metrics=True).app.test_client()
+    client.get('/widget/{:s}'.format(str(widget._id)))
+    requests_seen, commands = REQUEST_MONGO_COMMANDS.series('widget.show')
+    assert_equals(requests_seen, 1)
+    assert commands >= 1 # the find, at least
+    text = client.get('/_metrics').get_data(as_text=True)
+    assert 'pyro_request_duration_seconds_count{route="widget.show",'\
+            'method="GET",status="200"} 1' in text
+    assert 'pyro_mongo_command_duration_seconds_count{command="find"}' in text
+    Widget.delete_all()
+
+
+def encode_test():
+    _id = ObjectId()
+    doc = {'_id': _id, 'page_count': np.int64(12), 'scores': np.array([1.5]),
+           'read_at': datetime(2017, 7, 21, 10, 31),
+           'chapters': [{'chapter_title': 'Loomings', 'tags': ('sea',)}]}
+    assert_equals(json.loads(encode(doc)),\
+            {'_id': str(_id), 'pageCount': 12, 'scores': [1.5],
+             'readAt': '2017-07-21T10:31:00Z',
+             'chapters': [{'chapterTitle': 'Loomings', 'tags': ['sea']}]})
+
+
+def fields_param_test():
+    projection = fields_param({'fields': 'title,createdAt,stats.timesRead'})
+    assert_equals(sorted(projection),\
+            ['createdAt', 'stats.times_read', 'title'])
+    assert fields_param({}) is None
+    assert_raises(ValueError, fields_param, {'fields': '$where'})
+    assert_raises(ValueError, fields_param, {'fields': 'stats,stats.x'})
+
+
+def parse_query_test():
+    author_id = ObjectId()
+    args = {'pageCount__gt': '100', 'pageCount__lt': '500', 'inPrint': 'true',
+            'tags__in': 'sea,whales', '_authorId': str(author_id),
+            'isbn': '"0142437247"', 'limit': '10', 'sort': '-createdAt,title'}
+    query, sort = parse_query(args)
+    assert_equals(query, {'page_count': {'$gt': 100, '$lt': 500},
+                          'in_print': True,
+                          'tags': {'$in': ['sea', 'whales']},
+                          '_author_id': author_id,
+                          'isbn': '0142437247'})
+    assert_equals(sort, [('createdAt', -1), ('title', 1)])
+    assert_raises(ValueError, parse_query, {'age__near': '3'})
+    assert_raises(ValueError, parse_query, {'_authorId': 'mjl'})
+    query, _ = parse_query({'createdAt__gte': '2017-07-21',\
+            'updatedAt__lt': '2017-07-21T12:30:00+02:00'})
+    assert_equals(query, {'createdAt': {'$gte': datetime(2017, 7, 21)},\
+            'updatedAt': {'$lt': datetime(2017, 7, 21, 10, 30)}})
+    assert_raises(ValueError, parse_query, {'createdAt__gt': 'yesterday'})
+
+
+@with_setup(setup, teardown)
+def index_management_test():
+    class Author(Pyro): pass
+    class Book(Pyro): pass
+    Author.has_many(Book)
+    Book.has_index([('title', 1), ('pageCount', -1)], unique=True)
+    assert_equals([spec['keys'] for spec in Book._indexes],\
+            [[('_author_id', 1)], [('title', 1), ('page_count', -1)]])
+    Book.ensure_indexes()
+    assert_equals(Book.index_report()['books']['missing'], [])
+    Book._db['books'].drop_indexes()
+    assert_equals(len(Book.index_report()['books']['missing']), 2)
+
+
+def shared_client_test():
+    assert get_client() is get_client()
+    pooled = get_client(maxPoolSize=10, serverSelectionTimeoutMS=500)
+    assert pooled is get_client(serverSelectionTimeoutMS=500, maxPoolSize=10)
+    assert pooled is not get_client()
+
+
+def bad_client_options_test():
+    from pymongo.errors import ConfigurationError
+    assert_raises(ConfigurationError, connect_to_database, uri='mongo://x')
+
+
+@with_setup(setup, teardown)
+def per_model_database_test():
+    class Tome(Pyro): pass
+    Tome.attach_db(database='library', collection='tomes')
+    assert_equals(Tome._collection().full_name, 'library.tomes')
+    assert Tome._db.client is Pyro._db.client # same pool
+    assert_equals(Pyro._db.name, 'dev')
+
+
+def serve_config_test():
+    from pyro.application import gunicorn_application
+    server = gunicorn_application(None, {'bind': '0.0.0.0:8000',\
+            'workers': 3, 'threads': 4, 'accesslog': None})
+    assert_equals((server.cfg.workers, server.cfg.threads), (3, 4))
+    assert_equals(server.cfg.worker_class_str, 'gthread')
+
+
+@with_setup(setup, teardown)
+def document_cache_test():
+    from pyro.cache import MemoryCache, SharedCache, LocalStore
+    class Gizmo(Pyro): pass
+    for cache in [MemoryCache(maxsize=8), SharedCache(LocalStore())]:
+        Gizmo.attach_cache(cache)
+        gizmo = Gizmo.create({'name': 'sprocket'})
+        Gizmo.find_by_id(gizmo._id)
+        Gizmo.find_by_id(gizmo._id).name = 'mutated' # hits are copies
+        assert_equals(Gizmo.cache_stats()['hits'], 1)
+        assert_equals(Gizmo.find_by_id(gizmo._id).name, 'sprocket')
+        gizmo.name = 'cog'
+        gizmo.save() # invalidates
+        assert_equals(Gizmo.find_by_id(gizmo._id).name, 'cog')
+        Gizmo.update_many([{'_id': gizmo._id, 'name': 'gear'}])
+        assert_equals(Gizmo.find_by_id(gizmo._id).name, 'gear')
+        gizmo.delete()
+        assert_equals(Gizmo.find_by_id(gizmo._id), False)
+        # A read that a write overtakes is not cached.
+        key = Gizmo._cache_key(gizmo._id)
+        generation = cache.generation(key)
+        cache.delete(key)
+        cache.set(key, gizmo._doc, generation)
+        assert_equals(cache.get(key), None)
+        cache.set(key, gizmo._doc, cache.generation(key))
+        assert_equals(cache.get(key)['name'], 'cog')
+    Gizmo.attach_cache(None)
+    Gizmo.delete_all()
+
+
 # THESE TESTS REQUIRE THE TEST SERVER TO BE RUNNING.
 author_data = {'firstName': 'Matthew', 'lastName': 'Lewis', 'age': 41}
 book_data = [{'title': 'Moby-Dick', 'rating': 4.8},
@@ -149,6 +593,83 @@ def update_resource_test():
     assert_equals(update_resp.json()['favoriteAnimal'], 'amoeba')
 
 
+@with_setup(setup, teardown)
+def atomic_update_resource_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(dict(author_data, tags=['sea']))
+    update_url = url('author/{:s}'.format(author['_id']))
+    update_resp = requests.put(update_url, json={'$inc': {'age': 1},\
+            '$addToSet': {'tags': 'whale'}, 'favoriteAnimal': 'whale'})
+    assert_equals(update_resp.json()['age'], author['age'] + 1)
+    assert_equals(update_resp.json()['tags'], ['sea', 'whale'])
+    assert_equals(update_resp.json()['favoriteAnimal'], 'whale')
+    bad_resp = requests.put(update_url, json={'$rename': {'age': 'years'}})
+    assert_equals(bad_resp.status_code, 400)
+    for rejected in ({'$inc': {'age': 'old'}}, {'$push': {'age': 1}}):
+        bad_resp = requests.put(update_url, json=rejected) # Mongo refuses
+        assert_equals(bad_resp.status_code, 400)
+        assert bad_resp.json()['errors'][0]
+
+
+@with_setup(setup, teardown)
+def upsert_resource_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(author_data)
+    upsert_url = url('author/{:s}/books'.format(author['_id']))
+    book = {'isbn': '978-0142437247', 'title': 'Moby Dick'}
+    created = requests.patch(upsert_url, json=book).json()
+    book['title'] = 'Moby-Dick'
+    updated = requests.patch(upsert_url, json=book).json()
+    assert_equals(updated['_id'], created['_id'])
+    other = add_author(author_data)
+    other_url = url('author/{:s}/books'.format(other['_id']))
+    resp = requests.patch(other_url, json=book) # not other's to take
+    assert_equals(resp.status_code, 400)
+    show_url = url('book/{:s}'.format(created['_id']))
+    assert_equals(requests.get(show_url).json()['_authorId'], author['_id'])
+    assert_equals(updated['title'], 'Moby-Dick')
+    assert_equals(len(requests.get(url('books')).json()), 1)
+    missing_key_resp = requests.patch(upsert_url, json={'title': 'Emma'})
+    assert_equals(missing_key_resp.status_code, 400)
+
+
+@with_setup(setup, teardown)
+def count_and_aggregate_resource_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(author_data)
+    books_url = url('author/{:s}/books'.format(author['_id']))
+    requests.post(books_url + '/bulk', json=book_data)
+    add_author(author_data)
+    assert_equals(requests.get(url('authors/count')).json(), {'count': 2})
+    count_resp = requests.get(books_url + '/count?rating__gt=4.85')
+    assert_equals(count_resp.json(), {'count': 1})
+    groups = requests.get(books_url + '/aggregate?sum=rating').json()
+    assert_almost_equals(groups[0]['sum']['rating'], 9.7)
+    groups = requests.get(url('authors/aggregate?groupBy=age')).json()
+    assert_equals(groups, [{'age': 41, 'count': 2}])
+    bad_resp = requests.get(url('authors/aggregate?groupBy=no%20such'))
+    assert_equals(bad_resp.status_code, 400)
+
+
+@with_setup(setup, teardown)
+def delta_sync_resource_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(author_data)
+    books_url = url('author/{:s}/books'.format(author['_id']))
+    resp = requests.post(books_url + '/bulk', json=book_data)
+    books = resp.json()['created']
+    first = requests.get(books_url + '?since=').json()
+    assert_equals(len(first['changed']), 2)
+    page = requests.get(url('books?since=&limit=1')).json()
+    assert_equals((len(page['changed']), page['more']), (1, True))
+    requests.delete(url('book/{:s}'.format(books[0]['_id'])))
+    delta = requests.get(books_url + '?since=' + first['watermark']).json()
+    assert_equals(delta['deleted'], [books[0]['_id']])
+    assert_equals([b['_id'] for b in delta['changed']], [books[1]['_id']])
+    bad_resp = requests.get(url('books?since=&sort=title'))
+    assert_equals(bad_resp.status_code, 400)
+
+
 @with_setup(setup, teardown)
 def delete_resource_test():
     # NOTE: Assumes test server is running!!!
@@ -175,3 +696,76 @@ def nested_resource_test():
     assert_equals(book_resps[1]['title'], 'Ulysses')
 
 
+
+
+@with_setup(setup, teardown)
+def paginated_index_test():
+    # NOTE: Assumes test server is running!!!
+    for k in range(3):
+        add_author({'firstName': 'Author {:d}'.format(k)})
+    first_resp = requests.get(url('authors?limit=2'))
+    assert_equals(len(first_resp.json()), 2)
+    cursor = first_resp.headers['X-Next-Cursor']
+    next_resp = requests.get(url('authors?limit=2&after={:s}'.format(cursor)))
+    assert_equals(next_resp.json()[0]['firstName'], 'Author 2')
+    assert 'X-Next-Cursor' not in next_resp.headers
+    stream_resp = requests.get(url('authors?stream=true'))
+    assert_equals(len(stream_resp.json()), 3)
+
+
+@with_setup(setup, teardown)
+def bulk_resource_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(author_data)
+    bulk_url = url('author/{:s}/books/bulk'.format(author['_id']))
+    resp = requests.post(bulk_url, json=book_data)
+    assert_equals(resp.status_code, 200)
+    book_ids = [book['_id'] for book in resp.json()['created']]
+    resp = requests.delete(url('books/bulk'), json=book_ids + ['nope'])
+    assert_equals(resp.status_code, 207)
+    assert_equals(resp.json()['deleted'], book_ids)
+    assert_equals(resp.json()['errors'][0]['index'], 2)
+    resp = requests.put(url('books/bulk'), json=['abc'])
+    assert_equals(resp.status_code, 207)
+    assert_equals(resp.json()['errors'][0]['status'], 400)
+
+
+@with_setup(setup, teardown)
+def sparse_fieldset_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(author_data)
+    index_resp = requests.get(url('authors?fields=lastName'))
+    assert_equals(set(index_resp.json()[0]), set(['_id', 'lastName']))
+    show_url = url('author/{:s}?fields=age'.format(author['_id']))
+    assert_equals(requests.get(show_url).json()['age'], author_data['age'])
+    bad_resp = requests.get(url('authors?fields=last-name'))
+    assert_equals(bad_resp.status_code, 400)
+
+
+@with_setup(setup, teardown)
+def conditional_request_test():
+    # NOTE: Assumes test server is running!!!
+    author = add_author(author_data)
+    show_url = url('author/{:s}'.format(author['_id']))
+    resp = requests.get(show_url)
+    etag, last_modified = resp.headers['ETag'], resp.headers['Last-Modified']
+    resp = requests.get(show_url, headers={'If-None-Match': etag})
+    assert_equals(resp.status_code, 304)
+    assert_equals(resp.content, b'')
+    resp = requests.get(show_url, headers={'If-Modified-Since': last_modified})
+    assert_equals(resp.status_code, 304)
+    requests.put(show_url, json={'age': 42})
+    resp = requests.get(show_url, headers={'If-None-Match': etag})
+    assert_equals(resp.status_code, 200)
+    assert_equals(resp.json()['age'], 42)
+    index_resp = requests.get(url('authors'))
+    etag = index_resp.headers['ETag']
+    assert 'Last-Modified' not in index_resp.headers # the ETag covers lists
+    resp = requests.get(url('authors'),\
+            headers={'If-Modified-Since': last_modified})
+    assert_equals(resp.status_code, 200)
+    resp = requests.get(url('authors'), headers={'If-None-Match': etag})
+    assert_equals(resp.status_code, 304)
+    add_author(author_data)
+    resp = requests.get(url('authors'), headers={'If-None-Match': etag})
+    assert_equals(len(resp.json()), 2)
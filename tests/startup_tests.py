@@ -0,0 +1,38 @@
+'''Keep pyro quick to import. Short-lived workers and serverless functions pay
+for every module on the import path each time they start cold.'''
+import os
+import subprocess
+import sys
+from nose.tools import assert_equals
+
+IMPORT_BUDGET = 1.0 # seconds, for pyro.basics and all it imports
+HEAVY_MODULES = ['ipdb', 'IPython', 'numpy', 'inflect']
+
+
+def import_times(code):
+    '''Run code in a fresh interpreter under python -X importtime; return the
+       cumulative import time, in seconds, of every module it loaded.'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],\
+            env=env, stderr=subprocess.PIPE, universal_newlines=True,\
+            check=True)
+    times = {}
+    for line in run.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, module = line.split('|')
+            times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+
+# BEGIN TESTS ------------------------------------------------------
+def import_budget_test():
+    times = import_times('import pyro.basics')
+    assert times['pyro.basics'] < IMPORT_BUDGET, times['pyro.basics']
+    assert_equals([m for m in HEAVY_MODULES if m in times], [])
+
+
+def declared_names_skip_inflect_test():
+    times = import_times('from pyro.basics import *\n'\
+            'class Person(Pyro):\n'\
+            '    _plural_name = "people"')
+    assert 'inflect' not in times
@@ -19,6 +19,8 @@ if __name__ == '__main__':
 
     Pyro.attach_db()
     Author.has_many(Book)
+    Book.upserts_on('isbn')
+    Book.tracks_changes()
     Author.delete_all()
     Book.delete_all()
     app = Application(Pyro)